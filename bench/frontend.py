@@ -0,0 +1,60 @@
+"""Measure front end throughput: source lines per second through
+Scanner.scan_all alone and through Compiler.compile.
+
+Usage: pypy bench/frontend.py [lines] [runs]
+
+Generates a script of about `lines` lines (default 20000) with
+bench/generate.py and compiles it in this process, without the debug
+output the binaries print while compiling.
+PyPy runs the front end through its JIT much like the translated binaries
+do; Python 2 works as well, only slower.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lox.compiler import Compiler
+from lox.scanner import Scanner
+
+from generate import functions_for_lines, generate_source
+
+
+def scan(source):
+    return len(Scanner(source).scan_all().types)
+
+
+def compile_source(source):
+    if Compiler(source).compile() is None:
+        raise SystemExit("the generated script does not compile")
+
+
+def best_time(function, source, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        function(source)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(argv):
+    lines = int(argv[1]) if len(argv) > 1 else 20000
+    runs = int(argv[2]) if len(argv) > 2 else 5
+    source = generate_source(functions_for_lines(lines))
+    line_count = source.count("\n")
+    tokens = scan(source)
+
+    scan_time = best_time(scan, source, runs)
+    compile_time = best_time(compile_source, source, runs)
+
+    print("source:  %d lines, %d bytes, %d tokens" % (line_count, len(source), tokens))
+    print("scan:    %.4fs  %d lines/s  %d tokens/s"
+          % (scan_time, line_count / scan_time, tokens / scan_time))
+    print("compile: %.4fs  %d lines/s" % (compile_time, line_count / compile_time))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
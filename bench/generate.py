@@ -0,0 +1,45 @@
+"""Generated Lox scripts for the front end and startup benchmarks.
+
+They are shaped like machine generated code: many functions with locals,
+loops, conditionals, strings and comments, then a call to every one of
+them. Running them does little work, so most of their time goes to
+scanning and compiling.
+"""
+
+# Lines in every generated function, and a call to it at the end
+FUNCTION_LINES = 13
+LINES_PER_FUNCTION = FUNCTION_LINES + 1
+
+# The script takes one global slot for `total` besides one per function,
+# and global slots go up to 65536 with OP_WIDE. Constants go up to 2^24 per
+# chunk with OP_CONSTANT_LONG, so the global slots are the limit.
+MAX_FUNCTIONS = 65536 - 1
+
+
+def functions_for_lines(lines):
+    """How many functions make a script of about `lines` lines."""
+    return max(1, lines // LINES_PER_FUNCTION)
+
+
+def generate_source(functions):
+    """A script of `functions` functions, each called once."""
+    out = []
+    for i in range(functions):
+        out.append("fun f%d(first, second) {" % i)
+        out.append("    // Locals, constants and a string per function")
+        out.append("    var count = first + %d;" % i)
+        out.append("    var label = \"function number %d\";" % i)
+        out.append("    var ratio = (count * 2.5 - second) / 3;")
+        out.append("    for (var index = 0; index < 4; index = index + 1) {")
+        out.append("        var format = index * count;")
+        out.append("        if (count > second and ratio < format) { count = count - second; }")
+        out.append("        else { ratio = ratio + 1; }")
+        out.append("    }")
+        out.append("    while (ratio > 10 or !(count > 0)) { ratio = ratio / 2; count = count + 1; }")
+        out.append("    if (label == nil) return 0; else return count - ratio;")
+        out.append("}")
+    out.append("var total = 0;")
+    for i in range(functions):
+        out.append("total = total + f%d(1, 3);" % i)
+    out.append("print total;")
+    return "\n".join(out) + "\n"
@@ -0,0 +1,260 @@
+"""Run the Lox benchmarks in bench/ and report the timings as JSON.
+
+Usage: python bench/run.py [options] [workload ...]
+
+Runs every workload (fib, arithmetic, strings, calls, globals, branches by
+default) several times on each target:
+
+  untranslated  targetlox.py on PyPy or Python 2, like rlox.sh (slow,
+                best used with --small)
+  interp        rlox-interp, from `make targetlox-interp`
+  jit           rlox-jit, from `make targetlox-jit`
+
+Every workload prints a "round" line each time it finishes a round of its
+work. The runner notes when each of those lines arrives, so besides the
+median and standard deviation of the whole run it reports how long every
+round took: a warmup curve showing when the JIT kicks in. Every target runs
+with --quiet, so that untranslated runs do not spend their time printing
+the compiler's debug output and a trace of every instruction. Before timing,
+each workload is run once to write its .loxc file, so the timed runs do
+not include compiling it.
+
+With --baseline, the medians are compared against a report saved earlier
+with --output, and the exit status is 1 if any of them got slower by more
+than --threshold.
+"""
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+WORKLOADS = ["fib", "arithmetic", "strings", "calls", "globals", "branches"]
+TARGETS = ["untranslated", "interp", "jit"]
+MAKE_TARGETS = {"interp": "targetlox-interp", "jit": "targetlox-jit"}
+
+ROUND_MARKER = b"round"
+# A workload setting such as "var size = 25; // small: 12"
+SIZE_SETTING = re.compile(r"^(var \w+ = )\d+;\s*// small: (\d+)\s*$", re.MULTILINE)
+
+
+def workload_source(name, small):
+    with open(os.path.join(BENCH_DIR, name + ".lox")) as f:
+        source = f.read()
+    if small:
+        source = SIZE_SETTING.sub(r"\1\2;", source)
+    return source
+
+
+def find_python():
+    for name in ["pypy", "python2"]:
+        for directory in os.environ.get("PATH", "").split(os.pathsep):
+            path = os.path.join(directory, name)
+            if os.access(path, os.X_OK):
+                return path
+    return None
+
+
+def target_command(target, args):
+    """The command that runs a script on `target`, building the binary
+    first if it is missing and --build was given."""
+    if target == "untranslated":
+        python = args.python or find_python()
+        if python is None:
+            raise SystemExit("no pypy or python2 found, pass --python")
+        return [python, "-u", os.path.join(ROOT, "targetlox.py"), "--quiet"]
+    binary = getattr(args, target) or os.path.join(ROOT, "rlox-" + target)
+    if not os.path.exists(binary) and args.build:
+        subprocess.check_call(["make", MAKE_TARGETS[target]], cwd=ROOT)
+    if not os.path.exists(binary):
+        raise SystemExit("%s not found, build it with `make %s` or pass --build"
+                         % (binary, MAKE_TARGETS[target]))
+    return [os.path.abspath(binary), "--quiet"]
+
+
+def target_env():
+    # Untranslated runs import rpython from the PyPy checkout at the root
+    env = dict(os.environ)
+    paths = [ROOT, os.path.join(ROOT, "pypy")]
+    if env.get("PYTHONPATH"):
+        paths.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    return env
+
+
+def time_run(command, path, env):
+    """Run the script once. Returns the total time and the time of every
+    round."""
+    start = time.time()
+    last = start
+    rounds = []
+    output = []
+    process = subprocess.Popen(command + [path], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, env=env)
+    for line in iter(process.stdout.readline, b""):
+        if line.strip() == ROUND_MARKER:
+            now = time.time()
+            rounds.append(now - last)
+            last = now
+        else:
+            output.append(line)
+    process.stdout.close()
+    status = process.wait()
+    total = time.time() - start
+    if status != 0 or not rounds:
+        sys.stderr.write(b"".join(output[-20:]).decode("utf-8", "replace"))
+        raise SystemExit("%s failed on %s (exit status %d)"
+                         % (" ".join(command), path, status))
+    return total, rounds
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def stddev(values):
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / float(len(values))
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+
+
+def summarize(totals, rounds):
+    # Per round, the median over all runs that got that far
+    warmup = []
+    for i in range(max(len(r) for r in rounds)):
+        warmup.append(median([r[i] for r in rounds if i < len(r)]))
+    return {
+        "median": median(totals),
+        "stddev": stddev(totals),
+        "min": min(totals),
+        "times": totals,
+        "warmup": warmup,
+    }
+
+
+def run_target(target, workloads, args):
+    command = target_command(target, args)
+    env = target_env()
+    results = {}
+    directory = tempfile.mkdtemp(prefix="lox-bench-")
+    try:
+        for name in workloads:
+            path = os.path.join(directory, name + ".lox")
+            with open(path, "w") as f:
+                f.write(workload_source(name, args.small))
+            # Compiles the script and leaves its .loxc behind
+            time_run(command, path, env)
+            totals = []
+            rounds = []
+            for _ in range(args.runs):
+                total, run_rounds = time_run(command, path, env)
+                totals.append(total)
+                rounds.append(run_rounds)
+            results[name] = summarize(totals, rounds)
+            sys.stderr.write("%-12s %-10s median %.4fs  stddev %.4fs\n"
+                             % (target, name, results[name]["median"],
+                                results[name]["stddev"]))
+    finally:
+        shutil.rmtree(directory)
+    return {"command": command, "workloads": results}
+
+
+def compare(report, baseline, threshold):
+    """Print how every median changed since the baseline. Returns the
+    number of workloads that got slower by more than `threshold`."""
+    if report["small"] != baseline.get("small"):
+        sys.stderr.write("warning: the baseline was run with different sizes\n")
+    regressions = 0
+    for target, results in sorted(report["targets"].items()):
+        base_results = baseline.get("targets", {}).get(target)
+        if base_results is None:
+            continue
+        for name, result in sorted(results["workloads"].items()):
+            base = base_results["workloads"].get(name)
+            if base is None:
+                continue
+            change = result["median"] / base["median"] - 1
+            verdict = ""
+            if change > threshold:
+                verdict = "  SLOWER"
+                regressions += 1
+            elif change < -threshold:
+                verdict = "  faster"
+            sys.stderr.write("%-12s %-10s %.4fs -> %.4fs  %+.1f%%%s\n"
+                             % (target, name, base["median"], result["median"],
+                                change * 100, verdict))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Run the Lox benchmarks and report the timings as JSON.")
+    parser.add_argument("workloads", nargs="*", metavar="workload",
+                        help="workloads to run (default: all of %s)"
+                        % ", ".join(WORKLOADS))
+    parser.add_argument("--targets", default="interp,jit",
+                        help="comma separated, from %s (default: interp,jit)"
+                        % ", ".join(TARGETS))
+    parser.add_argument("--runs", type=int, default=5,
+                        help="timed runs per workload and target (default: 5)")
+    parser.add_argument("--small", action="store_true",
+                        help="use the small sizes in the workloads")
+    parser.add_argument("--build", action="store_true",
+                        help="build missing binaries with make")
+    parser.add_argument("--interp", help="path to rlox-interp")
+    parser.add_argument("--jit", help="path to rlox-jit")
+    parser.add_argument("--python", help="PyPy or Python 2 for untranslated runs")
+    parser.add_argument("--output", help="write the report here instead of stdout")
+    parser.add_argument("--baseline", help="report to compare the medians against")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="slowdown that counts as a regression (default: 0.05)")
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error("unknown workload %s" % name)
+    args.targets = args.targets.split(",")
+    for target in args.targets:
+        if target not in TARGETS:
+            parser.error("unknown target %s" % target)
+    if args.runs < 1:
+        parser.error("--runs must be at least 1")
+    return args
+
+
+def main(argv):
+    args = parse_args(argv[1:])
+    workloads = args.workloads or WORKLOADS
+    report = {"runs": args.runs, "small": args.small, "targets": {}}
+    for target in args.targets:
+        report["targets"][target] = run_target(target, workloads, args)
+
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,68 @@
+"""Compare startup with and without the .loxc bytecode cache.
+
+Usage: python bench/startup.py path/to/rlox-interp [runs] [functions]
+
+Generates a script that defines many small functions and does little work,
+so that runtime is dominated by scanning and compiling, then times runs
+with --recompile (cold) against runs that load the cached bytecode. The
+script comes from bench/generate.py; the default of 2000 functions makes
+it about 28000 lines long.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate import MAX_FUNCTIONS, generate_source
+
+
+def time_run(binary, args):
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        # Without --quiet, cold runs would mostly time printing the tokens
+        # and disassembly while compiling
+        subprocess.check_call([binary, "--quiet"] + args, stdout=devnull)
+        return time.time() - start
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 64
+    binary = os.path.abspath(argv[1])
+    runs = int(argv[2]) if len(argv) > 2 else 10
+    functions = int(argv[3]) if len(argv) > 3 else 2000
+    if not 0 < functions <= MAX_FUNCTIONS:
+        print("functions must be between 1 and %d" % MAX_FUNCTIONS)
+        return 64
+
+    directory = tempfile.mkdtemp(prefix="lox-startup-")
+    try:
+        path = os.path.join(directory, "startup.lox")
+        with open(path, "w") as f:
+            f.write(generate_source(functions))
+
+        cold = [time_run(binary, ["--recompile", path]) for _ in range(runs)]
+        # The last cold run left a fresh cache behind
+        cached = [time_run(binary, [path]) for _ in range(runs)]
+        cache_size = os.path.getsize(path + "c")
+        source_size = os.path.getsize(path)
+    finally:
+        shutil.rmtree(directory)
+
+    print("source:  %d bytes, cache: %d bytes" % (source_size, cache_size))
+    print("cold:    median %.4fs  min %.4fs" % (median(cold), min(cold)))
+    print("cached:  median %.4fs  min %.4fs" % (median(cached), min(cached)))
+    print("speedup: %.2fx" % (median(cold) / median(cached)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,5 +1,5 @@
 from lox.chunk import Chunk
 from lox.opcodes import OpCode
-from lox.scanner import Scanner, TokenTypes, Token
+from lox.scanner import Scanner, TokenTypes, Token, TokenStream
 from lox.compiler import Compiler
 from lox.vm import VM
@@ -0,0 +1,308 @@
+"""Compiled bytecode cache.
+
+`run_file` stores the compiled script next to its source (foo.lox =>
+foo.loxc) and loads it on the next run instead of scanning and compiling
+again. A cache file is used only if it was written by the same format
+version, for a source with the same content hash and at the same
+optimization level.
+
+Layout, with integers as 4 byte big endian and strings length-prefixed:
+
+    "LOXC" version opt_level source_md5
+    global_count global_name*
+    function
+
+    function := name arity code_count code_byte* run_count (start line)*
+                constant_count constant*
+    constant := TAG_NUMBER float64 | TAG_STRING string | TAG_FUNCTION function
+              | TAG_NIL | TAG_TRUE | TAG_FALSE
+
+Global slot numbers are baked into the code, so the global names are
+stored in slot order and registered again on load.
+"""
+import os
+
+from lox.chunk import Chunk
+from lox.object import ObjString, ObjFunction
+from lox.value import ValueNumber, ValueObj, w_nil, w_true, w_false
+
+from rpython.rlib import rmd5
+from rpython.rlib.rarithmetic import r_ulonglong, intmask
+from rpython.rlib.rstring import StringBuilder
+from rpython.rlib.rstruct.ieee import float_pack, float_unpack
+
+
+MAGIC = "LOXC"
+# Bump whenever the instruction set or the layout above changes
+VERSION = 3
+
+TAG_NUMBER = 0
+TAG_STRING = 1
+TAG_FUNCTION = 2
+TAG_NIL = 3
+TAG_TRUE = 4
+TAG_FALSE = 5
+
+READ_CHUNK_SIZE = 65536
+
+
+class CacheFormatError(Exception):
+    pass
+
+
+def cache_path(source_path):
+    if source_path.endswith(".lox"):
+        return source_path + "c"
+    return source_path + ".loxc"
+
+
+def source_hash(source):
+    return rmd5.RMD5(source).hexdigest()
+
+
+class Writer(object):
+    def __init__(self):
+        self.builder = StringBuilder()
+
+    def write_int(self, value):
+        self.builder.append(chr((value >> 24) & 0xff))
+        self.builder.append(chr((value >> 16) & 0xff))
+        self.builder.append(chr((value >> 8) & 0xff))
+        self.builder.append(chr(value & 0xff))
+
+    def write_byte(self, value):
+        self.builder.append(chr(value & 0xff))
+
+    def write_string(self, value):
+        self.write_int(len(value))
+        self.builder.append(value)
+
+    def write_float(self, value):
+        bits = float_pack(value, 8)
+        for i in range(8):
+            self.builder.append(chr(intmask(bits >> (56 - 8 * i)) & 0xff))
+
+    def write_function(self, function):
+        self.write_string(function.name)
+        self.write_int(function.arity)
+
+        chunk = function.chunk
+        self.write_int(chunk.get_count())
+        for i in range(chunk.get_count()):
+            self.write_byte(chunk.get_byte(i))
+        self.write_int(len(chunk.line_starts))
+        for i in range(len(chunk.line_starts)):
+            self.write_int(chunk.line_starts[i])
+            self.write_int(chunk.line_numbers[i])
+
+        self.write_int(chunk.constant_count())
+        for i in range(chunk.constant_count()):
+            self.write_constant(chunk.get_constant(i))
+
+    def write_constant(self, w_x):
+        if w_x is w_nil:
+            self.write_byte(TAG_NIL)
+        elif w_x is w_true:
+            self.write_byte(TAG_TRUE)
+        elif w_x is w_false:
+            self.write_byte(TAG_FALSE)
+        elif isinstance(w_x, ValueNumber):
+            self.write_byte(TAG_NUMBER)
+            self.write_float(w_x.value)
+        elif isinstance(w_x, ValueObj):
+            obj = w_x.get_value()
+            if isinstance(obj, ObjString):
+                self.write_byte(TAG_STRING)
+                self.write_string(obj.buffer)
+            elif isinstance(obj, ObjFunction):
+                self.write_byte(TAG_FUNCTION)
+                self.write_function(obj)
+            else:
+                raise CacheFormatError()
+        else:
+            raise CacheFormatError()
+
+    def getvalue(self):
+        return self.builder.build()
+
+
+class Reader(object):
+    def __init__(self, data, string_table):
+        self.data = data
+        self.pos = 0
+        self.string_table = string_table
+
+    def read_byte(self):
+        if self.pos >= len(self.data):
+            raise CacheFormatError()
+        value = ord(self.data[self.pos])
+        self.pos += 1
+        return value
+
+    def read_int(self):
+        value = 0
+        for i in range(4):
+            value = (value << 8) | self.read_byte()
+        return value
+
+    def read_string(self):
+        length = self.read_int()
+        start = self.pos
+        end = start + length
+        if end > len(self.data):
+            raise CacheFormatError()
+        assert start >= 0
+        assert end >= start
+        self.pos = end
+        return self.data[start:end]
+
+    def read_float(self):
+        bits = r_ulonglong(0)
+        for i in range(8):
+            bits = (bits << 8) | r_ulonglong(self.read_byte())
+        return float_unpack(bits, 8)
+
+    def read_function(self):
+        name = self.read_string()
+        arity = self.read_int()
+
+        chunk = Chunk()
+        count = self.read_int()
+        code = [self.read_byte() for i in range(count)]
+        runs = self.read_int()
+        offset = 0
+        line = 0
+        for i in range(runs):
+            start = self.read_int()
+            if start < offset or start > count or (i == 0 and start != 0):
+                raise CacheFormatError()
+            while offset < start:
+                chunk.write_chunk(code[offset], line)
+                offset += 1
+            line = self.read_int()
+        while offset < count:
+            chunk.write_chunk(code[offset], line)
+            offset += 1
+
+        constant_count = self.read_int()
+        for i in range(constant_count):
+            # The pool was deduplicated when it was written, so every
+            # constant lands at the index it had
+            if chunk.add_constant(self.read_constant()) != i:
+                raise CacheFormatError()
+
+        return ObjFunction(chunk=chunk, name=name, arity=arity)
+
+    def read_constant(self):
+        tag = self.read_byte()
+        if tag == TAG_NUMBER:
+            return ValueNumber(self.read_float())
+        elif tag == TAG_STRING:
+            return ValueObj(self.string_table.intern(self.read_string()))
+        elif tag == TAG_FUNCTION:
+            return ValueObj(self.read_function())
+        elif tag == TAG_NIL:
+            return w_nil
+        elif tag == TAG_TRUE:
+            return w_true
+        elif tag == TAG_FALSE:
+            return w_false
+        raise CacheFormatError()
+
+    def at_end(self):
+        return self.pos == len(self.data)
+
+
+def dump(function, source, opt_level, global_table):
+    writer = Writer()
+    writer.builder.append(MAGIC)
+    writer.write_int(VERSION)
+    writer.write_int(opt_level)
+    writer.write_string(source_hash(source))
+
+    writer.write_int(len(global_table.cells))
+    for cell in global_table.cells:
+        writer.write_string(cell.name)
+
+    writer.write_function(function)
+    return writer.getvalue()
+
+
+def load(data, source, opt_level, global_table, string_table):
+    """The script function stored in `data`, or None if it is stale, was
+    written by another version or does not parse."""
+    reader = Reader(data, string_table)
+    try:
+        for c in MAGIC:
+            if reader.read_byte() != ord(c):
+                return None
+        if reader.read_int() != VERSION:
+            return None
+        if reader.read_int() != opt_level:
+            return None
+        if reader.read_string() != source_hash(source):
+            return None
+
+        global_count = reader.read_int()
+        for slot in range(global_count):
+            if global_table.slot_for(reader.read_string()) != slot:
+                return None
+
+        function = reader.read_function()
+        if not reader.at_end():
+            return None
+        return function
+    except CacheFormatError:
+        return None
+
+
+def read_cache(path):
+    try:
+        fd = os.open(path, os.O_RDONLY, 0777)
+    except OSError:
+        return None
+    builder = StringBuilder()
+    try:
+        while True:
+            data = os.read(fd, READ_CHUNK_SIZE)
+            if not data:
+                break
+            builder.append(data)
+    except OSError:
+        os.close(fd)
+        return None
+    os.close(fd)
+    return builder.build()
+
+
+def write_cache(path, data):
+    # Write to a temporary file and rename it over the old cache, so a run
+    # racing with this one never reads half a file. Failing to write the
+    # cache (read-only directory, ...) only costs the next run a compile.
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    except OSError:
+        return False
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+    except OSError:
+        os.close(fd)
+        _remove(tmp_path)
+        return False
+    os.close(fd)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        _remove(tmp_path)
+        return False
+    return True
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
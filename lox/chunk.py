@@ -1,38 +1,196 @@
+import math
+
 from lox.debug import disassemble_instruction
-from lox.value import Value, ValueArray
+from lox.object import ObjString, ObjFunction
+from lox.optimizer import max_stack_depth
+from lox.value import Value, ValueArray, ValueNumber, ValueObj
+
+
+class Chunk(object):
+    """Bytecode of one function.
 
+    The compiler writes into `buffer` and `pool`. Before the chunk first
+    runs, freeze() moves them into `code` and `constants`, fixed-size
+    arrays that never change again, so traces constant-fold instruction
+    fetches and constant loads. Accessors like get_byte work in both
+    states; the VM reads the frozen arrays directly.
+    """
+    _immutable_fields_ = ['code[*]', 'constants[*]', 'max_stack']
 
-class Chunk:
     def __init__(self):
         self.count = 0
         self.capacity = 0
+        self.frozen = False
+        self.buffer = []
+        self.pool = ValueArray()
         self.code = []
-        self.lines = []
-        self.constants = ValueArray()
+        self.constants = []
+        # Opcodes the interpreter runs, rewritten in place by quickening.
+        # A separate copy, since `code` is immutable; traces only read code.
+        self.quickened = None
+        # Stack slots a call needs on top of the callee and its arguments,
+        # known once frozen
+        self.max_stack = 0
+        # Run-length encoded line table: the bytes from line_starts[i] up to
+        # line_starts[i + 1] all come from source line line_numbers[i]
+        self.line_starts = []
+        self.line_numbers = []
+        # Pool indices of number and string constants, so that repeated
+        # literals share one entry, and how many instructions use each entry
+        self.number_constants = {}
+        self.string_constants = {}
+        self.constant_uses = []
 
     def write_chunk(self, byte, line):
-        self.code.append(byte)
+        assert not self.frozen
+        if not self.line_numbers or self.line_numbers[-1] != line:
+            self.line_starts.append(self.count)
+            self.line_numbers.append(line)
+        self.buffer.append(byte)
         self.count += 1
-        self.lines.append(line)
+
+    def get_byte(self, offset):
+        if self.frozen:
+            return ord(self.code[offset])
+        return self.buffer[offset]
+
+    def get_constant(self, index):
+        if self.frozen:
+            return self.constants[index]
+        return self.pool[index]
+
+    def constant_count(self):
+        if self.frozen:
+            return len(self.constants)
+        return len(self.pool)
+
+    def freeze(self, quickening=False):
+        """Move the code and constants into their final arrays, along with
+        those of the functions defined in this chunk. A chunk can no longer
+        be written once frozen."""
+        if self.frozen:
+            return
+        self.code = [chr(byte) for byte in self.buffer]
+        self.constants = [self.pool[i] for i in range(len(self.pool))]
+        if quickening:
+            self.quickened = [chr(byte) for byte in self.buffer]
+        self.frozen = True
+        self.max_stack = max_stack_depth(self)
+
+        self.buffer = []
+        self.pool = ValueArray()
+        self.number_constants.clear()
+        self.string_constants.clear()
+        self.constant_uses = []
+
+        for w_x in self.constants:
+            if isinstance(w_x, ValueObj):
+                obj = w_x.get_value()
+                if isinstance(obj, ObjFunction):
+                    obj.chunk.freeze(quickening)
+
+    def quicken(self, offset, opcode):
+        self.quickened[offset] = chr(opcode)
+
+    def get_line(self, offset):
+        """Source line of the byte at `offset`."""
+        # Binary search for the last run starting at or before `offset`
+        low = 0
+        high = len(self.line_starts) - 1
+        while low < high:
+            middle = (low + high + 1) >> 1
+            if self.line_starts[middle] <= offset:
+                low = middle
+            else:
+                high = middle - 1
+        return self.line_numbers[low]
 
     def disassemble(self, name):
         print "== %s ==\n" % name,
         i = 0
-        while i < len(self.code):
+        while i < self.count:
             i = disassemble_instruction(self, i)
 
     def free_chunk(self):
         self.count = 0
         self.capacity = 0
-        self.code = []
-        self.lines = []
+        self.buffer = []
+        self.line_starts = []
+        self.line_numbers = []
 
     def add_constant(self, value):
-        self.constants.append(value)
-        return len(self.constants) - 1
+        assert not self.frozen
+        index = self._find_constant(value)
+        if index == -1:
+            self.pool.append(value)
+            self.constant_uses.append(0)
+            index = len(self.pool) - 1
+            self._index_constant(value, index)
+        self.constant_uses[index] += 1
+        return index
+
+    def _find_constant(self, value):
+        if isinstance(value, ValueNumber):
+            if _is_dedupable_number(value.value):
+                return self.number_constants.get(value.value, -1)
+        elif isinstance(value, ValueObj):
+            obj = value.get_value()
+            if isinstance(obj, ObjString) and obj.interned:
+                return self.string_constants.get(obj.buffer, -1)
+        return -1
+
+    def _index_constant(self, value, index):
+        if isinstance(value, ValueNumber):
+            if _is_dedupable_number(value.value):
+                self.number_constants[value.value] = index
+        elif isinstance(value, ValueObj):
+            obj = value.get_value()
+            if isinstance(obj, ObjString) and obj.interned:
+                self.string_constants[obj.buffer] = index
+
+    def _unindex_constant(self, value):
+        if isinstance(value, ValueNumber):
+            if _is_dedupable_number(value.value):
+                del self.number_constants[value.value]
+        elif isinstance(value, ValueObj):
+            obj = value.get_value()
+            if isinstance(obj, ObjString) and obj.interned:
+                del self.string_constants[obj.buffer]
+
+    def remove_constant(self, index):
+        """Drop one use of constant `index`. The constant itself goes once
+        nothing uses it, if it is the last one in the pool, so that
+        folded-away literals do not linger in it."""
+        self.constant_uses[index] -= 1
+        if self.constant_uses[index] > 0 or index != len(self.pool) - 1:
+            return False
+        self._unindex_constant(self.pool.pop())
+        self.constant_uses.pop()
+        return True
 
     def get_count(self):
         return self.count
 
     def set_to_code(self, offset, value):
-        self.code[offset] = value
+        assert not self.frozen
+        self.buffer[offset] = value
+
+    def truncate(self, count):
+        """Drop all bytes from offset `count` on."""
+        assert count >= 0
+        assert not self.frozen
+        self.buffer = self.buffer[:count]
+        self.count = count
+        runs = len(self.line_starts)
+        while runs > 0 and self.line_starts[runs - 1] >= count:
+            runs -= 1
+        assert runs >= 0
+        self.line_starts = self.line_starts[:runs]
+        self.line_numbers = self.line_numbers[:runs]
+
+
+def _is_dedupable_number(value):
+    # -0.0 == 0.0 and NaN != NaN, so neither can be looked up by value
+    if value == 0.0:
+        return math.copysign(1.0, value) > 0.0
+    return value == value
@@ -1,20 +1,28 @@
 import math
 
 from lox.chunk import Chunk
-from lox.opcodes import OpCode
+from lox.opcodes import OpCode, operand_size, instruction_size, wide_operand_size
+from lox.optimizer import assemble
 from lox.object import ObjString, ObjFunction, ObjType
-from lox.scanner import Scanner, TokenTypes, debug_token
-from lox.value import Value, ValueNumber, ValueBool, ValueObj
+from lox.scanner import Scanner, TokenTypes, debug_token_type
+from lox.table import GlobalTable, StringTable
+from lox.value import Value, ValueNumber, ValueBool, ValueObj, w_nil, w_true, w_false, wrap_bool
 
 from rpython.rlib import jit
 
 UINT8_MAX = math.pow(2, 8)
 UINT16_MAX = math.pow(2, 16)
 
+# Limits of the wide encodings: two byte slots after OP_WIDE, and the three
+# byte pool index of OP_CONSTANT_LONG
+SLOT_COUNT_MAX = 1 << 16
+CONSTANT_COUNT_MAX = 1 << 24
+
 class Parser(object):
     def __init__(self):
-        self.current = None
-        self.previous = None
+        # Indexes into the compiler's token stream
+        self.current = -1
+        self.previous = -1
         self.panic_mdoe = False
         self.had_error = False
 
@@ -49,9 +57,13 @@ class ParseRule(object):
             raise Exception("unsupported item: %d " % item)
 
 class Local(object):
-    def __init__(self, token, depth):
+    def __init__(self, token, depth, name, shadowed):
         self.token = token
         self.depth = depth
+        # Number of the name in the token stream, and the slot of the
+        # local of the same name this one hides, or -1
+        self.name = name
+        self.shadowed = shadowed
 
     def get_depth(self):
         return self.depth
@@ -68,27 +80,52 @@ class FunctionType(object):
 
 class Compiler(object):
 
-    def __init__(self, source, type=FunctionType.SCRIPT, debug_print=False):
+    def __init__(self, source, type=FunctionType.SCRIPT, debug_print=False,
+                 global_table=None, string_table=None):
         self.source = source
-        self.scanner = Scanner(source)
+        # Scanned all at once by compile(), and shared with the compilers
+        # of nested functions
+        self.tokens = None
         self.parser = Parser()
         self.chunk = Chunk()
         self.type = type
         self.debug_print = debug_print
-
-        self._LOCAL_COUNT_MAX = 16
-        self.local_variables = [None] * self._LOCAL_COUNT_MAX
-        self.local_count = 0
+        if global_table is None:
+            global_table = GlobalTable()
+        self.global_table = global_table
+        if string_table is None:
+            string_table = StringTable()
+        self.string_table = string_table
+
+        self._LOCAL_COUNT_MAX = SLOT_COUNT_MAX
+        self.local_variables = [None] * 16
+        # Name number => slot of the innermost local of that name in scope
+        self.local_slots = {}
         self.scope_depth = 0
 
+        # Peephole state: where each emitted instruction starts, how many
+        # operand bytes of the last one are still to come, and the highest
+        # offset a jump lands on. Instructions are never fused across it.
+        self.instruction_starts = []
+        self.pending_operands = 0
+        self.last_label = 0
+        # Forward jumps too long for their 16 bit operand: operand offset =>
+        # target offset. end_compiler re-encodes them with OP_WIDE.
+        self.long_jumps = {}
+
+        # Slot 0 of every call frame holds the callee itself
+        self.local_variables[0] = Local(-1, 0, -1, -1)
+        self.local_count = 1
+
     def new_compiler(self, type):
-        compiler = Compiler(self.source, type, self.debug_print)
-        compiler.scanner = self.scanner
+        compiler = Compiler(self.source, type, self.debug_print,
+                            self.global_table, self.string_table)
+        compiler.tokens = self.tokens
         compiler.parser = self.parser
         return compiler
 
     def compile(self):
-        line = -1
+        self.tokens = Scanner(self.source).scan_all()
         self.advance()
 
         # self.expression()
@@ -106,16 +143,18 @@ class Compiler(object):
         self.parser.previous = self.parser.current
 
         while True:
-            token = self.scanner.scan_token()
+            # Stays on the final EOF once it gets there
+            if self.parser.current < self.tokens.last():
+                self.parser.current += 1
+            token_type = self.tokens.type_at(self.parser.current)
             if self.debug_print:
-                print "Scanning token %s" % (debug_token(token))
-            self.parser.current = token
-            if self.parser.current.type != TokenTypes.ERROR:
+                print "Scanning token %s" % (debug_token_type(token_type))
+            if token_type != TokenTypes.ERROR:
                 break
-            self._error_at_current(self.parser.current.message)
+            self._error_at_current(self.tokens.string_at(self.parser.current))
 
     def consume(self, token_type, message):
-        if self.parser.current.type == token_type:
+        if self.tokens.type_at(self.parser.current) == token_type:
             self.advance()
             return
 
@@ -129,10 +168,12 @@ class Compiler(object):
         return True
 
     def _check(self, token_type):
-        return self.parser.current.type == token_type
+        return self.tokens.type_at(self.parser.current) == token_type
 
     def end_compiler(self, func_name="<script>", func_arity=0):
         self.emit_return()
+        if self.long_jumps:
+            assemble(self.current_chunk(), self.long_jumps)
 
         function = ObjFunction(chunk=self.current_chunk(),
                                name=func_name,
@@ -156,19 +197,24 @@ class Compiler(object):
         ):
             self.emit_byte(OpCode.OP_POP)
             self.local_count -= 1
+            local = self.local_variables[self.local_count]
+            if local.shadowed == -1:
+                del self.local_slots[local.name]
+            else:
+                self.local_slots[local.name] = local.shadowed
 
     def number(self, can_assign):
-        value = float(self.scanner.get_token_string(self.parser.previous))
+        value = float(self.tokens.string_at(self.parser.previous))
         lox_value = ValueNumber(value)
         self.emit_constant(lox_value)
 
     def string(self, can_assign):
         # the value itself has decorated with double quotes
-        string_value = self.scanner.get_token_string(self.parser.previous)
+        string_value = self.tokens.string_at(self.parser.previous)
         # remove " and extract the value
         slice_end = len(string_value) - 1
         assert slice_end > 0
-        string_obj = ObjString(string_value[1:slice_end])
+        string_obj = self.string_table.intern(string_value[1:slice_end])
         w_x = ValueObj(string_obj)
         self.emit_constant(w_x)
 
@@ -176,27 +222,24 @@ class Compiler(object):
         self._named_variable(self.parser.previous, can_assign)
 
     def _named_variable(self, token, can_assign):
-        # name = self.scanner.get_token_string(token)
-        # arg = self._identifier_constant(name)
-
         arg = self._resolve_local(token)
         if arg != -1:
             get_op = OpCode.OP_GET_LOCAL
             set_op = OpCode.OP_SET_LOCAL
         else:
-            name = self.scanner.get_token_string(token)
-            arg = self._identifier_constant(name)
-            get_op = OpCode.OP_GET_GLOBAL
-            set_op = OpCode.OP_SET_GLOBAL
+            name = self.tokens.name_at(token)
+            arg = self._global_slot(name)
+            get_op = OpCode.OP_GET_GLOBAL_SLOT
+            set_op = OpCode.OP_SET_GLOBAL_SLOT
 
         if can_assign and self.match(TokenTypes.EQUAL):
             self.expression()
-            self.emit_bytes(set_op, arg)
+            self._emit_slot_instruction(set_op, arg)
         else:
-            self.emit_bytes(get_op, arg)
+            self._emit_slot_instruction(get_op, arg)
 
     def literal(self, can_assign):
-        op_type = self.parser.previous.type
+        op_type = self.tokens.type_at(self.parser.previous)
         if op_type == TokenTypes.FALSE:
             self.emit_byte(OpCode.OP_FALSE)
         elif op_type == TokenTypes.NIL:
@@ -205,11 +248,14 @@ class Compiler(object):
             self.emit_byte(OpCode.OP_TRUE)
 
     def unary(self, can_assign):
-        operator_type = self.parser.previous.type
+        operator_type = self.tokens.type_at(self.parser.previous)
 
         # Compile the operand
         self.parse_precedence(Precedence.UNARY)
 
+        if self._fold_unary(operator_type):
+            return
+
         # Emit the instruction
         if operator_type == TokenTypes.BANG:
             self.emit_byte(OpCode.OP_NOT)
@@ -217,10 +263,13 @@ class Compiler(object):
             self.emit_byte(OpCode.OP_NEGATE)
 
     def binary(self, can_assign):
-        op_type = self.parser.previous.type
+        op_type = self.tokens.type_at(self.parser.previous)
         rule = self._get_rule(op_type)
         self.parse_precedence(rule.precedence + 1)
 
+        if self._fold_binary(op_type) or self._simplify_binary(op_type):
+            return
+
         if op_type == TokenTypes.PLUS:
             self.emit_byte(OpCode.OP_ADD)
         if op_type == TokenTypes.MINUS:
@@ -230,17 +279,150 @@ class Compiler(object):
         if op_type == TokenTypes.SLASH:
             self.emit_byte(OpCode.OP_DIVIDE)
         if op_type == TokenTypes.BANG_EQUAL:
-            self.emit_bytes(OpCode.OP_EQUAL, OpCode.OP_NEGATE)
+            self.emit_byte(OpCode.OP_NOT_EQUAL)
         if op_type == TokenTypes.EQUAL_EQUAL:
             self.emit_byte(OpCode.OP_EQUAL)
         if op_type == TokenTypes.GREATER:
             self.emit_byte(OpCode.OP_GREATER)
         if op_type == TokenTypes.GREATER_EQUAL:
-            self.emit_bytes(OpCode.OP_LESS, OpCode.OP_NEGATE)
+            self.emit_byte(OpCode.OP_GREATER_EQUAL)
         if op_type == TokenTypes.LESS:
             self.emit_byte(OpCode.OP_LESS)
         if op_type == TokenTypes.LESS_EQUAL:
-            self.emit_bytes(OpCode.OP_GREATER, OpCode.OP_NEGATE)
+            self.emit_byte(OpCode.OP_LESS_EQUAL)
+
+    def _constant_at(self, offset):
+        """The value pushed by the instruction at `offset` if it is a
+        foldable literal, otherwise None."""
+        chunk = self.current_chunk()
+        op = chunk.get_byte(offset)
+        if op == OpCode.OP_CONSTANT or op == OpCode.OP_CONSTANT_LONG:
+            w_x = chunk.get_constant(self._constant_index(offset))
+            if w_x.is_number() or w_x.is_string():
+                return w_x
+        elif op == OpCode.OP_TRUE:
+            return w_true
+        elif op == OpCode.OP_FALSE:
+            return w_false
+        elif op == OpCode.OP_NIL:
+            return w_nil
+        return None
+
+    def _discard_code(self, offset):
+        """Remove the code from `offset` on, along with the constants only
+        that code used."""
+        chunk = self.current_chunk()
+        i = len(self.instruction_starts) - 1
+        while i >= 0 and self.instruction_starts[i] >= offset:
+            start = self.instruction_starts[i]
+            op = chunk.get_byte(start)
+            if op == OpCode.OP_CONSTANT or op == OpCode.OP_CONSTANT_LONG:
+                chunk.remove_constant(self._constant_index(start))
+            i -= 1
+        self._rewind(offset)
+
+    def _constant_index(self, offset):
+        chunk = self.current_chunk()
+        if chunk.get_byte(offset) == OpCode.OP_CONSTANT_LONG:
+            return (chunk.get_byte(offset + 1) << 16 |
+                    chunk.get_byte(offset + 2) << 8 |
+                    chunk.get_byte(offset + 3))
+        return chunk.get_byte(offset + 1)
+
+    def _replace_with_constant(self, offset, w_x):
+        """Replace the code from `offset` on with a single push of `w_x`."""
+        self._discard_code(offset)
+        if w_x is w_true:
+            self.emit_byte(OpCode.OP_TRUE)
+        elif w_x is w_false:
+            self.emit_byte(OpCode.OP_FALSE)
+        elif w_x is w_nil:
+            self.emit_byte(OpCode.OP_NIL)
+        else:
+            self.emit_constant(w_x)
+
+    def _fold_unary(self, operator_type):
+        operand = self._fusable_instruction(0)
+        if operand == -1:
+            return False
+        w_x = self._constant_at(operand)
+        if w_x is None:
+            return False
+
+        if operator_type == TokenTypes.BANG:
+            self._replace_with_constant(operand, wrap_bool(w_x.is_falsy()))
+            return True
+        elif operator_type == TokenTypes.MINUS and isinstance(w_x, ValueNumber):
+            self._replace_with_constant(operand, w_x.negate())
+            return True
+        return False
+
+    def _fold_binary(self, op_type):
+        left = self._fusable_instruction(1)
+        if left == -1:
+            return False
+        w_x = self._constant_at(left)
+        w_y = self._constant_at(self._fusable_instruction(0))
+        if w_x is None or w_y is None:
+            return False
+
+        w_z = None
+        if op_type == TokenTypes.EQUAL_EQUAL:
+            w_z = wrap_bool(w_x.is_equal(w_y))
+        elif op_type == TokenTypes.BANG_EQUAL:
+            w_z = wrap_bool(not w_x.is_equal(w_y))
+        elif isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber):
+            if op_type == TokenTypes.PLUS:
+                w_z = w_x.add(w_y)
+            elif op_type == TokenTypes.MINUS:
+                w_z = w_x.sub(w_y)
+            elif op_type == TokenTypes.STAR:
+                w_z = w_x.mul(w_y)
+            elif op_type == TokenTypes.SLASH and w_y.value != 0.0:
+                w_z = w_x.div(w_y)
+            elif op_type == TokenTypes.LESS:
+                w_z = wrap_bool(w_x.value < w_y.value)
+            elif op_type == TokenTypes.LESS_EQUAL:
+                w_z = wrap_bool(w_x.value <= w_y.value)
+            elif op_type == TokenTypes.GREATER:
+                w_z = wrap_bool(w_x.value > w_y.value)
+            elif op_type == TokenTypes.GREATER_EQUAL:
+                w_z = wrap_bool(w_x.value >= w_y.value)
+        elif op_type == TokenTypes.PLUS and w_x.is_string() and w_y.is_string():
+            assert isinstance(w_x, ValueObj)
+            assert isinstance(w_y, ValueObj)
+            obj_str1 = w_x.get_value()
+            obj_str2 = w_y.get_value()
+            assert isinstance(obj_str1, ObjString)
+            assert isinstance(obj_str2, ObjString)
+            w_z = ValueObj(self.string_table.intern(obj_str1.buffer + obj_str2.buffer))
+
+        if w_z is None:
+            return False
+        self._replace_with_constant(left, w_z)
+        return True
+
+    def _simplify_binary(self, op_type):
+        # x - 0, x * 1 and x / 1 are x whenever x is already known to be a
+        # number, i.e. it was just produced by arithmetic that would have
+        # failed otherwise. (x + 0 is not: -0 + 0 is 0.)
+        left = self._fusable_instruction(1)
+        if left == -1:
+            return False
+        if self.current_chunk().get_byte(left) not in (OpCode.OP_SUBTRACT, OpCode.OP_MULTIPLY,
+                              OpCode.OP_DIVIDE, OpCode.OP_NEGATE):
+            return False
+        right = self._fusable_instruction(0)
+        w_y = self._constant_at(right)
+        if not isinstance(w_y, ValueNumber):
+            return False
+
+        if ((op_type == TokenTypes.MINUS and w_y.value == 0.0)
+                or (op_type == TokenTypes.STAR and w_y.value == 1.0)
+                or (op_type == TokenTypes.SLASH and w_y.value == 1.0)):
+            self._discard_code(right)
+            return True
+        return False
 
     def call(self, can_assign):
         arg_count = self._argument_list()
@@ -266,7 +448,7 @@ class Compiler(object):
 
     def parse_precedence(self, precedence):
         self.advance()
-        prefix_rule = self._get_rule(self.parser.previous.type).prefix
+        prefix_rule = self._get_rule(self.tokens.type_at(self.parser.previous)).prefix
         if prefix_rule is None:
             self._error("Expect expression.")
             return
@@ -274,40 +456,39 @@ class Compiler(object):
         can_assign = precedence <= Precedence.ASSIGNMENT
         prefix_rule(self, can_assign)
 
-        while precedence <= self._get_rule(self.parser.current.type).precedence:
+        while precedence <= self._get_rule(self.tokens.type_at(self.parser.current)).precedence:
             self.advance()
-            infix_rule = self._get_rule(self.parser.previous.type).infix
+            infix_rule = self._get_rule(self.tokens.type_at(self.parser.previous)).infix
             infix_rule(self, can_assign)
 
         if can_assign and self.match(TokenTypes.EQUAL):
             self._error("Invalid assignment target.")
 
-    def _identifier_constant(self, name):
-        w_obj = ValueObj(ObjString(name))
-        return self._make_constant(w_obj)
-
-    def _identifier_equal(self, token1, token2):
-        return (
-            self.scanner.get_token_string(token1) == self.scanner.get_token_string(token2)
-        )
+    def _global_slot(self, name):
+        slot = self.global_table.slot_for(name)
+        if slot >= SLOT_COUNT_MAX:
+            self._error("Too many global variables.")
+            return 0
+        return slot
 
     def _resolve_local(self, token):
-        for i in range(self.local_count):
-            local = self.local_variables[i]
-            if self._identifier_equal(token, local.get_token()):
-                if local.get_depth() == -1:
-                    self._error("Can't read local variable in its own initializer.")
-                return i
-        return -1
+        slot = self.local_slots.get(self.tokens.name_id(token), -1)
+        if slot != -1 and self.local_variables[slot].get_depth() == -1:
+            self._error("Can't read local variable in its own initializer.")
+        return slot
 
     def _add_local(self, token):
         if self.local_count == self._LOCAL_COUNT_MAX:
             self._error("Too many local variables in function.")
             return
+        if self.local_count == len(self.local_variables):
+            self.local_variables = self.local_variables + [None] * len(self.local_variables)
 
+        name = self.tokens.name_id(token)
         # local = Local(token, self.scope_depth)
-        local = Local(token, -1)
+        local = Local(token, -1, name, self.local_slots.get(name, -1))
         self.local_variables[self.local_count] = local
+        self.local_slots[name] = self.local_count
         self.local_count += 1
 
     def _declare_variable(self):
@@ -315,12 +496,12 @@ class Compiler(object):
 
         token = self.parser.previous
 
-        for i in range(self.local_count):
-            local = self.local_variables[i]
-            if local.get_depth() != -1 and local.get_depth() < self.scope_depth:
-                break
-
-            if self._identifier_equal(token, local.get_token()):
+        # Locals of outer scopes may be shadowed, but not the ones declared
+        # in this scope, which is the innermost one
+        slot = self.local_slots.get(self.tokens.name_id(token), -1)
+        if slot != -1:
+            depth = self.local_variables[slot].get_depth()
+            if depth == -1 or depth == self.scope_depth:
                 self._error("Already a variable with this name in this scope.")
 
         self._add_local(token)
@@ -331,8 +512,8 @@ class Compiler(object):
         self._declare_variable()
         if self.scope_depth > 0: return 0
 
-        name = self.scanner.get_token_string(self.parser.previous)
-        return self._identifier_constant(name)
+        name = self.tokens.name_at(self.parser.previous)
+        return self._global_slot(name)
 
     def _mark_initialized(self):
         if self.scope_depth == 0:
@@ -343,7 +524,7 @@ class Compiler(object):
         if self.scope_depth > 0:
             self._mark_initialized()
             return
-        self.emit_bytes(OpCode.OP_DEFINE_GLOBAL, global_var)
+        self._emit_slot_instruction(OpCode.OP_DEFINE_GLOBAL_SLOT, global_var)
 
     def _argument_list(self):
         arg_count = 0
@@ -370,7 +551,7 @@ class Compiler(object):
     def function(self, type):
         compiler = self.new_compiler(type)
 
-        name = compiler.scanner.get_token_string(compiler.parser.previous)
+        name = compiler.tokens.name_at(compiler.parser.previous)
         compiler._begin_scope()
 
         compiler.consume(TokenTypes.LEFT_PAREN, "Expect '(' after function name.")
@@ -390,15 +571,12 @@ class Compiler(object):
         compiler.block()
 
         function = compiler.end_compiler(func_name=name, func_arity=arity)
-        self.emit_bytes(
-            OpCode.OP_CONSTANT,
-            self._make_constant(ValueObj(function))
-        )
+        self.emit_constant(ValueObj(function))
 
     def fun_declaration(self):
         global_name = self._parse_variable("Expect function name.")
         self._mark_initialized()
-        self.function(ObjType.FUNCTION)
+        self.function(FunctionType.FUNCTION)
         self._define_variable(global_name)
 
     def var_declaration(self):
@@ -429,34 +607,27 @@ class Compiler(object):
         else:
             self.expression_statement()
 
-        loop_start = self.current_chunk().get_count()
-        exit_jump = -1
-
+        branch = OpCode.OP_LOOP
+        condition = []
+        condition_lines = []
         if not self.match(TokenTypes.SEMICOLON):
-            self.expression()
+            branch, condition, condition_lines = self._loop_condition()
             self.consume(TokenTypes.SEMICOLON, "Expect ';' after loop condition.")
 
-            exit_jump = self.emit_jump(OpCode.OP_JUMP_IF_FALSE)
-            self.emit_byte(OpCode.OP_POP)
-
+        increment = []
+        increment_lines = []
         if not self.match(TokenTypes.RIGHT_PAREN):
-            body_jump = self.emit_jump(OpCode.OP_JUMP)
-            increment_start = self.current_chunk().get_count()
+            increment_start = self._mark_label()
             self.expression()
             self.emit_byte(OpCode.OP_POP)
             self.consume(TokenTypes.RIGHT_PAREN, "Expect ')' after condition.")
+            increment, increment_lines = self._cut_code(increment_start)
 
-            self.emit_loop(loop_start)
-            loop_start = increment_start
-            self._patch_jump(body_jump)
-
+        entry_jump = self._emit_loop_entry(branch)
+        body_start = self._mark_label()
         self.statement()
-
-        self.emit_loop(loop_start)
-
-        if exit_jump != -1:
-            self._patch_jump(exit_jump)
-            self.emit_byte(OpCode.OP_POP)
+        self._paste_code(increment, increment_lines)
+        self._close_loop(entry_jump, body_start, branch, condition, condition_lines)
 
         self._end_scope()
 
@@ -465,46 +636,95 @@ class Compiler(object):
         self.expression()
         self.consume(TokenTypes.RIGHT_PAREN, "Expect ')' after condition.")
 
-        then_jump = self.emit_jump(OpCode.OP_JUMP_IF_FALSE)
-        self.emit_byte(OpCode.OP_POP)
+        then_jump = self._emit_condition_jump()
         self.statement() # then branch statement
 
-        else_jump = self.emit_jump(OpCode.OP_JUMP)
-
-        self._patch_jump(then_jump)
-        self.emit_byte(OpCode.OP_POP)
-
         if self.match(TokenTypes.ELSE):
+            else_jump = self.emit_jump(OpCode.OP_JUMP)
+            self._patch_jump(then_jump)
             self.statement() # else branch statement
-
-        self._patch_jump(else_jump)
+            self._patch_jump(else_jump)
+        else:
+            self._patch_jump(then_jump)
 
     def print_statement(self):
         self.expression()
         self.consume(TokenTypes.SEMICOLON, "Expect ';' after value.")
         self.emit_byte(OpCode.OP_PRINT)
 
+    def return_statement(self):
+        if self.type == FunctionType.SCRIPT:
+            self._error("Can't return from top-level code.")
+
+        if self.match(TokenTypes.SEMICOLON):
+            self.emit_return()
+        else:
+            self.expression()
+            self.consume(TokenTypes.SEMICOLON, "Expect ';' after return value.")
+            self.emit_byte(OpCode.OP_RETURN)
+
     def while_statement(self):
-        loop_start = self.current_chunk().get_count()
         self.consume(TokenTypes.LEFT_PAREN, "Expect '(' after 'while'.")
-        self.expression()
+        branch, condition, condition_lines = self._loop_condition()
         self.consume(TokenTypes.RIGHT_PAREN, "Expect ')' after condition.")
 
-        exit_jump = self.emit_jump(OpCode.OP_JUMP_IF_FALSE)
-        self.emit_byte(OpCode.OP_POP)
+        entry_jump = self._emit_loop_entry(branch)
+        body_start = self._mark_label()
         self.statement()
-        self.emit_loop(loop_start)
+        self._close_loop(entry_jump, body_start, branch, condition, condition_lines)
+
+    # Loops are rotated so that the condition is tested at the bottom and
+    # each iteration ends in a single backward branch:
+    #
+    #           JUMP cond        (left out when the condition is always true)
+    #     body: <body>
+    #           <increment>
+    #     cond: <condition>
+    #           LOOP_IF_* body
+    #
+    # The parser sees the condition and the increment before the body, so
+    # their code is compiled first, cut out of the chunk and pasted back
+    # after the body. Jumps are relative and constants stay in the pool, so
+    # the moved code runs unchanged.
+
+    def _loop_condition(self):
+        """Compile a loop condition and take it out of the chunk. Returns the
+        instruction that closes the loop, with the condition's code and
+        lines."""
+        start = self._mark_label()
+        self.expression()
 
-        self._patch_jump(exit_jump)
-        self.emit_byte(OpCode.OP_POP)
+        branch = OpCode.OP_POP_LOOP_IF_TRUE
+        last = self._fusable_instruction(0)
+        if last != -1:
+            op = self.current_chunk().get_byte(last)
+            if op in OpCode.CompareLoopOps:
+                self._rewind(last)
+                branch = OpCode.CompareLoopOps[op]
+
+        code, lines = self._cut_code(start)
+        if branch == OpCode.OP_POP_LOOP_IF_TRUE and len(code) == 1 and code[0] == OpCode.OP_TRUE:
+            return OpCode.OP_LOOP, [], []
+        return branch, code, lines
+
+    def _emit_loop_entry(self, branch):
+        if branch == OpCode.OP_LOOP:
+            return -1
+        return self.emit_jump(OpCode.OP_JUMP)
+
+    def _close_loop(self, entry_jump, body_start, branch, condition, condition_lines):
+        if entry_jump != -1:
+            self._patch_jump(entry_jump)
+        self._paste_code(condition, condition_lines)
+        self.emit_loop(body_start, branch)
 
     def synchronize(self):
         self.parser.panic_mdoe = False
 
-        while self.parser.current.type != TokenTypes.EOF:
-            if self.parser.previous.type == TokenTypes.SEMICOLON:
+        while self.tokens.type_at(self.parser.current) != TokenTypes.EOF:
+            if self.tokens.type_at(self.parser.previous) == TokenTypes.SEMICOLON:
                 return
-            if self.parser.current.type in (
+            if self.tokens.type_at(self.parser.current) in (
                     TokenTypes.CLASS,
                     TokenTypes.FUN,
                     TokenTypes.VAR,
@@ -537,6 +757,8 @@ class Compiler(object):
             self.if_statement()
         elif self.match(TokenTypes.FOR):
             self.for_statement()
+        elif self.match(TokenTypes.RETURN):
+            self.return_statement()
         elif self.match(TokenTypes.WHILE):
             self.while_statement()
         elif self.match(TokenTypes.LEFT_BRACE):
@@ -547,19 +769,28 @@ class Compiler(object):
             self.expression_statement()
 
     def emit_byte(self, byte1):
-        self.current_chunk().write_chunk(byte1, self.parser.previous.line)
+        chunk = self.current_chunk()
+        if self.pending_operands == 0:
+            self.instruction_starts.append(chunk.get_count())
+            self.pending_operands = operand_size(byte1)
+        else:
+            self.pending_operands -= 1
+        chunk.write_chunk(byte1, self.tokens.line_at(self.parser.previous))
+
+        if self.pending_operands == 0:
+            self._peephole()
 
     def emit_bytes(self, byte1, byte2):
         self.emit_byte(byte1)
         self.emit_byte(byte2)
 
-    def emit_loop(self, loop_start):
-        self.emit_byte(OpCode.OP_LOOP)
-
-        offset = self.current_chunk().get_count() - loop_start + 2
-        if offset > UINT16_MAX:
-            self._error("Loop body too large.")
+    def emit_loop(self, loop_start, instruction=OpCode.OP_LOOP):
+        offset = self.current_chunk().get_count() - loop_start + 3
+        if offset > 0xffff:
+            self._emit_wide(instruction, offset + 3)
+            return
 
+        self.emit_byte(instruction)
         self.emit_byte((offset >> 8) & 0xff)
         self.emit_byte(offset & 0xff)
 
@@ -569,7 +800,22 @@ class Compiler(object):
         self.emit_byte(0xff)
         return self.current_chunk().get_count() - 2
 
+    def _emit_condition_jump(self):
+        """Emit a forward jump taken when the condition just compiled is
+        false. The condition is consumed on both paths.
+
+        A trailing comparison is folded into the jump, so the condition
+        never pushes a boolean."""
+        last = self._fusable_instruction(0)
+        if last != -1:
+            op = self.current_chunk().get_byte(last)
+            if op in OpCode.CompareBranchOps:
+                self._rewind(last)
+                return self.emit_jump(OpCode.CompareBranchOps[op])
+        return self.emit_jump(OpCode.OP_POP_JUMP_IF_FALSE)
+
     def emit_return(self):
+        self.emit_byte(OpCode.OP_NIL)
         self.emit_byte(OpCode.OP_RETURN)
 
     def grouping(self, can_assign):
@@ -579,23 +825,136 @@ class Compiler(object):
     def _make_constant(self, value):
         chunk = self.current_chunk()
         constant = chunk.add_constant(value)
-        if constant > 255:
+        if constant >= CONSTANT_COUNT_MAX:
             self._error("Too many constants in one chunk.")
             return 0
         return constant
 
     def emit_constant(self, value):
-        self.emit_bytes(OpCode.OP_CONSTANT, self._make_constant(value))
+        constant = self._make_constant(value)
+        if constant <= 0xff:
+            self.emit_bytes(OpCode.OP_CONSTANT, constant)
+        else:
+            self.emit_byte(OpCode.OP_CONSTANT_LONG)
+            self.emit_byte((constant >> 16) & 0xff)
+            self.emit_byte((constant >> 8) & 0xff)
+            self.emit_byte(constant & 0xff)
+
+    def _emit_slot_instruction(self, instruction, slot):
+        if slot <= 0xff:
+            self.emit_bytes(instruction, slot)
+        else:
+            self._emit_wide(instruction, slot)
+
+    def _emit_wide(self, instruction, operand):
+        """Emit `instruction` behind an OP_WIDE prefix. Wide instructions
+        never take part in peephole fusion."""
+        chunk = self.current_chunk()
+        line = self.tokens.line_at(self.parser.previous)
+        self.instruction_starts.append(chunk.get_count())
+        chunk.write_chunk(OpCode.OP_WIDE, line)
+        chunk.write_chunk(instruction, line)
+        size = wide_operand_size(instruction)
+        for i in range(size):
+            chunk.write_chunk((operand >> (8 * (size - 1 - i))) & 0xff, line)
+
+    def _mark_label(self):
+        # Something will jump to the current offset
+        self.last_label = self.current_chunk().get_count()
+        return self.last_label
+
+    def _fusable_instruction(self, n):
+        """Start of the n-th most recent instruction, or -1 if there is no
+        such instruction or a jump lands between it and the end of the
+        chunk."""
+        i = len(self.instruction_starts) - 1 - n
+        if i < 0:
+            return -1
+        offset = self.instruction_starts[i]
+        if offset < self.last_label:
+            return -1
+        return offset
+
+    def _rewind(self, offset):
+        self.current_chunk().truncate(offset)
+        while self.instruction_starts and self.instruction_starts[-1] >= offset:
+            self.instruction_starts.pop()
+
+    def _cut_code(self, offset):
+        """Remove the code from `offset` on and return it with its lines.
+        Unlike _discard_code this keeps its constants, as the code is meant
+        to be pasted back later."""
+        assert offset >= 0
+        for jump_op_offset in self.long_jumps:
+            if jump_op_offset >= offset:
+                # Its entry in long_jumps would not move with the code
+                self._error("Loop clause too large.")
+        chunk = self.current_chunk()
+        code = [chunk.get_byte(i) for i in range(offset, chunk.get_count())]
+        lines = [chunk.get_line(i) for i in range(offset, chunk.get_count())]
+        self._rewind(offset)
+        return code, lines
+
+    def _paste_code(self, code, lines):
+        chunk = self.current_chunk()
+        i = 0
+        while i < len(code):
+            self.instruction_starts.append(chunk.get_count())
+            end = i + instruction_size(code, i)
+            while i < end:
+                chunk.write_chunk(code[i], lines[i])
+                i += 1
+
+    def _fuse(self, offset, superinstruction, operand1, operand2):
+        self._rewind(offset)
+        self.emit_byte(superinstruction)
+        self.emit_byte(operand1)
+        self.emit_byte(operand2)
+
+    def _peephole(self):
+        # Replace the instruction just emitted, together with the ones before
+        # it, with a superinstruction when they form a known pattern
+        last = self._fusable_instruction(0)
+        if last == -1:
+            return
+        chunk = self.current_chunk()
+        op = chunk.get_byte(last)
+
+        if op == OpCode.OP_GET_LOCAL:
+            # GET_LOCAL a, GET_LOCAL b => GET_LOCAL_GET_LOCAL a b
+            first = self._fusable_instruction(1)
+            if first != -1 and chunk.get_byte(first) == OpCode.OP_GET_LOCAL:
+                self._fuse(first, OpCode.OP_GET_LOCAL_GET_LOCAL,
+                           chunk.get_byte(first + 1), chunk.get_byte(last + 1))
+        elif op == OpCode.OP_ADD:
+            # GET_LOCAL a, CONSTANT k, ADD => ADD_LOCAL_CONST a k
+            first = self._fusable_instruction(2)
+            if first != -1 and chunk.get_byte(first) == OpCode.OP_GET_LOCAL:
+                constant = self._fusable_instruction(1)
+                if chunk.get_byte(constant) == OpCode.OP_CONSTANT:
+                    self._fuse(first, OpCode.OP_ADD_LOCAL_CONST,
+                               chunk.get_byte(first + 1), chunk.get_byte(constant + 1))
+        elif op == OpCode.OP_POP:
+            # ADD_LOCAL_CONST a k, SET_LOCAL a, POP => INCR_LOCAL a k
+            first = self._fusable_instruction(2)
+            if first != -1 and chunk.get_byte(first) == OpCode.OP_ADD_LOCAL_CONST:
+                store = self._fusable_instruction(1)
+                if (chunk.get_byte(store) == OpCode.OP_SET_LOCAL
+                        and chunk.get_byte(store + 1) == chunk.get_byte(first + 1)):
+                    self._fuse(first, OpCode.OP_INCR_LOCAL,
+                               chunk.get_byte(first + 1), chunk.get_byte(first + 2))
 
     def _patch_jump(self, jump_op_offset):
-        count = self.current_chunk().get_count()
+        count = self._mark_label()
         jump_distance = count - jump_op_offset - 2
 
         # if self.debug_print:
         #     print "jump disance", jump_distance
 
-        if jump_distance > UINT16_MAX:
-            self._error("Too much code to jump over.")
+        if jump_distance > 0xffff:
+            # Leave the operand for end_compiler to widen
+            self.long_jumps[jump_op_offset] = count
+            return
 
         jump1 = (jump_distance >> 8) & 0xff
         jump2 = jump_distance & 0xff
@@ -607,14 +966,15 @@ class Compiler(object):
         if self.parser.panic_mdoe:
             return
 
-        print "[line %d] Error" % token.line,
+        print "[line %d] Error" % self.tokens.line_at(token),
 
-        if token.type == TokenTypes.EOF:
+        token_type = self.tokens.type_at(token)
+        if token_type == TokenTypes.EOF:
             print " at end",
-        elif token.type == TokenTypes.ERROR:
+        elif token_type == TokenTypes.ERROR:
             pass
         else:
-            print " at '%s'" % self.scanner.get_token_string(token),
+            print " at '%s'" % self.tokens.string_at(token),
         print ": %s\n" % msg
 
         self.parser.had_error = True
@@ -1,5 +1,5 @@
 # Based on https://github.com/hardbyte/pylox/blob/master/lox/debug.py
-from lox.opcodes import OpCode
+from lox.opcodes import OpCode, wide_operand_size
 
 OpCodeToInstructionName = {getattr(OpCode, op): op
                            for op in dir(OpCode) if op.startswith('OP_')}
@@ -27,37 +27,65 @@ def simple_instruction(name, offset):
 
 
 def binary_instruction(name, chunk, offset):
-    #op_name = OpCode.BinaryOps[chunk.code[offset - 1]]
+    #op_name = OpCode.BinaryOps[chunk.get_byte(offset - 1)]
     return "", offset + 1
 
 
 def byte_instruction(name, chunk, offset):
-    slot = chunk.code[offset + 1]
+    slot = chunk.get_byte(offset + 1)
     return str(slot), offset + 2
 
 
+def two_byte_instruction(name, chunk, offset):
+    slot1 = chunk.get_byte(offset + 1)
+    slot2 = chunk.get_byte(offset + 2)
+    return "%d %d" % (slot1, slot2), offset + 3
+
+
+def local_constant_instruction(name, chunk, offset):
+    slot = chunk.get_byte(offset + 1)
+    constant = chunk.get_byte(offset + 2)
+    return "%d %s" % (slot, format_constant(name, chunk, constant)), offset + 3
+
+
 def format_constant(name, chunk, constant):
     return "(%s) %s" % (
         leftpad_string("%d" % constant, 2, '0'),
-        leftpad_string("'%s'" % chunk.constants[constant].repr(), 10)
+        leftpad_string("'%s'" % chunk.get_constant(constant).repr(), 10)
     )
 
 
 def constant_instruction(name, chunk, offset):
-    constant = chunk.code[offset + 1]
+    constant = chunk.get_byte(offset + 1)
     return format_constant(name, chunk, constant), offset + 2
 
 
+def constant_long_instruction(name, chunk, offset):
+    constant = (chunk.get_byte(offset + 1) << 16 |
+                chunk.get_byte(offset + 2) << 8 |
+                chunk.get_byte(offset + 3))
+    return format_constant(name, chunk, constant), offset + 4
+
+
+def wide_instruction(name, chunk, offset):
+    instruction = chunk.get_byte(offset + 1)
+    operand = 0
+    size = wide_operand_size(instruction)
+    for i in range(size):
+        operand = operand << 8 | chunk.get_byte(offset + 2 + i)
+    return "%s %d" % (get_instruction_name(instruction), operand), offset + 2 + size
+
+
 def jump_instruction(name, chunk, offset):
-    jump1 = chunk.code[offset + 1] << 8 & 0xff
-    jump2 = chunk.code[offset + 2] & 0xff
+    jump1 = chunk.get_byte(offset + 1) << 8 & 0xff
+    jump2 = chunk.get_byte(offset + 2) & 0xff
     return "%d %d" % (jump1, jump2), offset + 3
 
 
 def get_printable_location(ip, chunk):
     line_number = format_line_number(chunk, ip)
     instruction_index = format_ip(ip)
-    instruction = chunk.code[ip]
+    instruction = chunk.get_byte(ip)
     instruction_name = format_instruction(get_instruction_name(instruction))
     _, instruction_extras = format_instruction_extended(chunk, instruction, instruction_name, ip)
     return "%s %s %s %s" % (line_number, instruction_index, instruction_name, instruction_extras)
@@ -66,7 +94,7 @@ def get_printable_location(ip, chunk):
 def disassemble_instruction(chunk, offset):
     print format_ip(offset),
 
-    instruction = chunk.code[offset]
+    instruction = chunk.get_byte(offset)
     if instruction not in OpCodeToInstructionName:
         print "Unknown opcode %s" % instruction
         return offset + 1
@@ -89,6 +117,10 @@ def format_instruction_extended(chunk, instruction, instruction_name, offset):
 
     if instruction == OpCode.OP_CONSTANT:
         repr, ip = constant_instruction(instruction_name, chunk, offset)
+    elif instruction == OpCode.OP_CONSTANT_LONG:
+        repr, ip = constant_long_instruction(instruction_name, chunk, offset)
+    elif instruction == OpCode.OP_WIDE:
+        repr, ip = wide_instruction(instruction_name, chunk, offset)
     elif instruction == OpCode.OP_FALSE:
         repr = "FALSE"
         ip = offset + 1
@@ -100,17 +132,20 @@ def format_instruction_extended(chunk, instruction, instruction_name, offset):
     elif instruction in (
             OpCode.OP_SET_LOCAL,
             OpCode.OP_GET_LOCAL,
-            OpCode.OP_GET_GLOBAL,
-            OpCode.OP_SET_GLOBAL,
+            OpCode.OP_GET_GLOBAL_SLOT,
+            OpCode.OP_SET_GLOBAL_SLOT,
             OpCode.OP_CALL,
-            OpCode.OP_DEFINE_GLOBAL,
+            OpCode.OP_DEFINE_GLOBAL_SLOT,
     ):
         repr, ip = byte_instruction(instruction_name, chunk, offset)
+    elif instruction == OpCode.OP_GET_LOCAL_GET_LOCAL:
+        repr, ip = two_byte_instruction(instruction_name, chunk, offset)
     elif instruction in (
-            OpCode.OP_JUMP_IF_FALSE,
-            OpCode.OP_JUMP,
-            OpCode.OP_LOOP
+            OpCode.OP_ADD_LOCAL_CONST,
+            OpCode.OP_INCR_LOCAL,
     ):
+        repr, ip = local_constant_instruction(instruction_name, chunk, offset)
+    elif instruction in OpCode.JumpOps:
         repr, ip = jump_instruction(instruction_name, chunk, offset)
     else:
         repr, ip = simple_instruction(instruction_name, offset)
@@ -130,7 +165,8 @@ def format_instruction(instruction_name):
 
 
 def format_line_number(chunk, offset):
-    if offset > 0 and chunk.lines[offset] == chunk.lines[offset - 1]:
+    line = chunk.get_line(offset)
+    if offset > 0 and line == chunk.get_line(offset - 1):
         return "   |"
     else:
-        return leftpad_string(str(chunk.lines[offset]), 4)
+        return leftpad_string(str(line), 4)
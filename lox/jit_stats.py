@@ -0,0 +1,164 @@
+"""JIT tuning and statistics for the command line.
+
+`--jit` forwards its argument to rpython.rlib.jit.set_user_param, and
+`--jit-stats` prints a summary of what the JIT did when the script ends:
+compiled loops and bridges, aborted traces and why, how often compiled
+code was entered and left through bridges, and time spent tracing.
+"""
+import time
+
+from rpython.rlib import jit, jit_hooks
+from rpython.rlib.jit import Counters, JitHookInterface
+from rpython.rlib.nonconst import NonConstant
+from rpython.rlib.rfloat import formatd
+
+# Set by the translation target for JIT builds. The statistics helpers only
+# exist there, so everything below checks it first.
+JIT_ENABLED = False
+
+
+class JitEvents(object):
+    """What the hooks saw. The hooks object itself must not be reachable
+    from the interpreter, so they record into this one instead.
+
+    The annotator sees the hooks after the rest of the interpreter, when
+    it is too late to widen the type of anything they store. So they only
+    count, and reset() makes sure the counts are not taken for constants."""
+
+    def __init__(self):
+        self.too_long = 0
+        self.compiled_ops = 0
+        self.machine_code_bytes = 0
+
+    def reset(self):
+        self.too_long = NonConstant(0)
+        self.compiled_ops = NonConstant(0)
+        self.machine_code_bytes = NonConstant(0)
+
+
+events = JitEvents()
+
+
+class LoxJitHooks(JitHookInterface):
+    def on_trace_too_long(self, jitdriver, greenkey, greenkey_repr):
+        # The function or loop at greenkey is no longer traced from its start
+        events.too_long += 1
+
+    def after_compile(self, debug_info):
+        self._compiled(debug_info)
+
+    def after_compile_bridge(self, debug_info):
+        self._compiled(debug_info)
+
+    def _compiled(self, debug_info):
+        events.compiled_ops += len(debug_info.operations)
+        asminfo = debug_info.asminfo
+        if asminfo is not None:
+            length = asminfo.asmlen
+            if length > 0:
+                events.machine_code_bytes += length
+
+
+hooks = LoxJitHooks()
+
+
+def set_params(text):
+    """Apply `--jit` parameters such as "threshold=200,inlining=0" or "off".
+    Returns False if `text` does not parse."""
+    try:
+        jit.set_user_param(None, text)
+    except ValueError:
+        return False
+    except jit.TraceLimitTooHigh:
+        return False
+    return True
+
+
+class JitStats(object):
+    def __init__(self):
+        self.start_time = 0.0
+
+    def start(self):
+        self.start_time = time.time()
+        events.reset()
+        if JIT_ENABLED:
+            # Makes the backend count entries into every loop and bridge
+            # it compiles from now on
+            jit_hooks.stats_set_debug(None, True)
+
+    def print_summary(self):
+        total = time.time() - self.start_time
+        print "JIT summary"
+        if not JIT_ENABLED:
+            print "  not available: this build has no JIT"
+            return
+
+        print "  loops compiled:     %d" % _counter(Counters.TOTAL_COMPILED_LOOPS)
+        print "  bridges compiled:   %d" % _counter(Counters.TOTAL_COMPILED_BRIDGES)
+        print "  operations:         %d" % events.compiled_ops
+        print "  machine code:       %d bytes" % events.machine_code_bytes
+
+        ll_times = jit_hooks.stats_get_loop_run_times(None)
+        if len(ll_times) > 0:
+            entries, iterations, bridge_runs = _loop_runs(ll_times)
+            print "  compiled entries:   %d" % entries
+            print "  loop iterations:    %d" % iterations
+            print "  bridge runs:        %d (guard failures handled by a bridge)" % bridge_runs
+        else:
+            # The backend only adds run counters to the code it emits while
+            # its debug log is on
+            print "  run counts:         set PYPYLOG=jit-backend:/dev/null to collect"
+
+        aborts = (_counter(Counters.ABORT_TOO_LONG) + _counter(Counters.ABORT_BRIDGE)
+                  + _counter(Counters.ABORT_BAD_LOOP) + _counter(Counters.ABORT_ESCAPE)
+                  + _counter(Counters.ABORT_FORCE_QUASIIMMUT))
+        print "  aborted traces:     %d" % aborts
+        _print_abort_count("trace too long", Counters.ABORT_TOO_LONG)
+        _print_abort_count("bridge", Counters.ABORT_BRIDGE)
+        _print_abort_count("bad loop", Counters.ABORT_BAD_LOOP)
+        _print_abort_count("virtualizable escape", Counters.ABORT_ESCAPE)
+        _print_abort_count("quasi-immutable forced", Counters.ABORT_FORCE_QUASIIMMUT)
+        if events.too_long:
+            print "    traced from inside instead: %d" % events.too_long
+
+        tracing = _time(Counters.TRACING)
+        backend = _time(Counters.BACKEND)
+        print "  tracing:            %ss" % _seconds(tracing)
+        print "  compiling:          %ss" % _seconds(backend)
+        print "  everything else:    %ss (interpreter and compiled code)" % _seconds(total - tracing - backend)
+        print "  total:              %ss" % _seconds(total)
+
+
+def _counter(counter):
+    return jit_hooks.stats_get_counter_value(None, counter)
+
+
+def _time(counter):
+    return jit_hooks.stats_get_times_value(None, counter)
+
+
+def _seconds(value):
+    return formatd(value, 'f', 3)
+
+
+def _print_abort_count(name, counter):
+    count = _counter(counter)
+    if count:
+        print "    %s: %d" % (name, count)
+
+
+def _loop_runs(ll_times):
+    """Times compiled code was entered from the interpreter, times a loop
+    went around, and times a bridge ran."""
+    entries = 0
+    iterations = 0
+    bridge_runs = 0
+    for i in range(len(ll_times)):
+        kind = ll_times[i].type
+        if kind == 'e':
+            entries += ll_times[i].counter
+        elif kind == 'l':
+            iterations += ll_times[i].counter
+        elif kind == 'b':
+            bridge_runs += ll_times[i].counter
+    return entries, iterations, bridge_runs
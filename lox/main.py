@@ -1,12 +1,49 @@
 import os
 import readline
-import math
 
+from lox import bytecode_cache, jit_stats, profiler, sampler
 from lox.chunk import Chunk
 from lox.opcodes import OpCode
 from lox.vm import VM, InterpretCompileError, InterpretRuntimeError
 
 from rpython.rlib import rfile, jit
+from rpython.rlib.rarithmetic import intmask
+from rpython.rlib.rstring import StringBuilder
+
+# -O0 runs the bytecode as compiled, -O1 runs the post-compile passes once
+# and -O2 repeats them until they stop finding anything. See lox/optimizer.py.
+DEFAULT_OPT_LEVEL = 1
+MAX_OPT_LEVEL = 2
+
+# Sources whose size fstat does not tell (pipes, ...) are read in pieces
+# of this size
+READ_CHUNK_SIZE = 65536
+
+
+class Options(object):
+    def __init__(self):
+        self.opt_level = DEFAULT_OPT_LEVEL
+        # Print the tokens and disassembly while compiling, and untranslated
+        # every instruction as it runs
+        self.debug = True
+        # Compile even if a fresh .loxc exists (and overwrite it)
+        self.recompile = False
+        # Neither read nor write .loxc files
+        self.use_cache = True
+        # Print what the JIT did when the script ends
+        self.jit_stats = False
+        # Count instructions, and report them when the script ends: as
+        # text, or as JSON written to profile_path if it is set
+        self.profile = False
+        self.profile_path = ""
+        # Time calls, and report them as text or as a callgrind file
+        # written to call_profile_path if it is set
+        self.profile_calls = False
+        self.call_profile_path = ""
+        # Sample the call stack this many times a second and write the
+        # samples to sample_path, if it is set
+        self.sample_path = ""
+        self.sample_rate = sampler.DEFAULT_RATE
 
 def test_chunk(argv):
     chunk = Chunk()
@@ -35,10 +72,10 @@ def test_chunk(argv):
     return 0
 
 
-def repl():
+def repl(options):
     prompt = '> '
     LINE_BUFFER_LENGTH = 4096
-    vm = VM(debug=True)
+    vm = VM(debug=options.debug, opt_level=options.opt_level)
 
     print "Welcome to lox"
 
@@ -58,12 +95,26 @@ def repl():
         stdout.write("Byte!\n")
 
 
-def run_file(filename):
-
+def run_file(filename, options):
+    """Run the script at `filename`. Returns the exit status."""
     source = read_file(filename)
-    vm = VM(debug=True)
+    if source is None:
+        return 74
+    vm = VM(debug=options.debug, opt_level=options.opt_level)
+    stats = jit_stats.JitStats()
+    if options.jit_stats:
+        stats.start()
+    if profiler.PROFILING_ENABLED and options.profile:
+        vm.profile = profiler.InstructionProfile()
+    if profiler.PROFILING_ENABLED and options.profile_calls:
+        vm.call_profile = profiler.CallProfile(filename)
+    if options.sample_path:
+        sampler.start(options.sample_path, options.sample_rate)
     try:
-        result = vm.interpret(source)
+        function = load_function(vm, filename, source, options)
+        if function is None:
+            return 0
+        result = vm.interpret_function(function)
     except InterpretCompileError as e:
         print "Compile error"
         raise e
@@ -72,28 +123,178 @@ def run_file(filename):
         raise e
     except ValueError:
         print "Unhandled exception in runFile"
+    if options.jit_stats:
+        stats.print_summary()
+    if profiler.PROFILING_ENABLED:
+        report_profiles(vm, options)
+    if sampler.state.sampler is not None and not sampler.state.sampler.write():
+        print "Could not write samples to %s" % options.sample_path
+    return 0
+
+
+def report_profiles(vm, options):
+    if vm.profile is not None:
+        if not options.profile_path:
+            vm.profile.print_report()
+        elif not vm.profile.write_json(options.profile_path):
+            print "Could not write profile to %s" % options.profile_path
+    if vm.call_profile is not None:
+        if not options.call_profile_path:
+            vm.call_profile.print_report()
+        elif not vm.call_profile.write_callgrind(options.call_profile_path):
+            print "Could not write profile to %s" % options.call_profile_path
+
+
+def load_function(vm, filename, source, options):
+    """The compiled script for `source`, from its .loxc file when that is
+    fresh. Returns None after a compile error."""
+    path = bytecode_cache.cache_path(filename)
+    if options.use_cache and not options.recompile:
+        data = bytecode_cache.read_cache(path)
+        if data is not None:
+            function = bytecode_cache.load(data, source, vm.opt_level,
+                                           vm.global_table, vm.string_table)
+            if function is not None:
+                return function
+
+    function = vm.compile(source)
+    if function is not None and options.use_cache:
+        data = bytecode_cache.dump(function, source, vm.opt_level, vm.global_table)
+        bytecode_cache.write_cache(path, data)
+    return function
 
 
 def read_file(filename):
+    """The contents of `filename`, or None if it cannot be read."""
     try:
         # file = rfile.create_file(filename, 'r')
         file = os.open(filename, os.O_RDONLY, 0777)
-    except IOError:
+    except OSError:
         print "Error opening file"
-        raise SystemExit(74)
-    source = os.read(file, int(math.pow(2, 20)))
+        return None
+    try:
+        source = read_all(file)
+    except OSError:
+        os.close(file)
+        print "Error reading file"
+        return None
     os.close(file)
     return source
 
 
+def read_all(fd):
+    """Everything there is to read from `fd`, of any size. A regular file
+    comes in with one read of its whole size, straight into the string the
+    scanner then works on; only when that falls short are the pieces
+    joined."""
+    size = intmask(os.fstat(fd).st_size)
+    data = ""
+    if size > 0:
+        data = os.read(fd, size)
+    more = os.read(fd, READ_CHUNK_SIZE)
+    if not more:
+        return data
+    builder = StringBuilder(len(data) + len(more) + READ_CHUNK_SIZE)
+    builder.append(data)
+    while more:
+        builder.append(more)
+        more = os.read(fd, READ_CHUNK_SIZE)
+    return builder.build()
+
+
+def usage():
+    print ("Usage: lox [-O0|-O1|-O2] [--quiet] [--recompile] [--no-cache] [--jit <params>|--jit off] [--jit-stats]\n"
+           "           [--profile] [--profile-json <path>] [--profile-calls] [--profile-callgrind <path>]\n"
+           "           [--sample <path>] [--sample-rate <per second>] [path]")
+    return 64
+
+
+def parse_opt_level(arg):
+    """The level of an -O<n> argument, or -1 if it is not a valid one."""
+    if len(arg) != 3 or not arg[2].isdigit():
+        return -1
+    level = ord(arg[2]) - ord('0')
+    if level > MAX_OPT_LEVEL:
+        return -1
+    return level
+
+
+def parse_sample_rate(arg):
+    """The rate given to --sample-rate, or -1 if it is not a valid one."""
+    try:
+        rate = int(arg)
+    except ValueError:
+        return -1
+    if rate <= 0:
+        return -1
+    return rate
+
+
 def main(argv):
+    options = Options()
+    paths = []
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg.startswith("-O"):
+            options.opt_level = parse_opt_level(arg)
+            if options.opt_level < 0:
+                return usage()
+        elif arg == "--quiet":
+            options.debug = False
+        elif arg == "--recompile":
+            options.recompile = True
+        elif arg == "--no-cache":
+            options.use_cache = False
+        elif arg == "--jit":
+            if i == len(argv) or not jit_stats.set_params(argv[i]):
+                return usage()
+            i += 1
+        elif arg == "--jit-stats":
+            options.jit_stats = True
+        elif arg == "--profile":
+            options.profile = True
+        elif arg == "--profile-json":
+            if i == len(argv):
+                return usage()
+            options.profile = True
+            options.profile_path = argv[i]
+            i += 1
+        elif arg == "--profile-calls":
+            options.profile_calls = True
+        elif arg == "--profile-callgrind":
+            if i == len(argv):
+                return usage()
+            options.profile_calls = True
+            options.call_profile_path = argv[i]
+            i += 1
+        elif arg == "--sample":
+            if i == len(argv):
+                return usage()
+            options.sample_path = argv[i]
+            i += 1
+        elif arg == "--sample-rate":
+            if i == len(argv):
+                return usage()
+            options.sample_rate = parse_sample_rate(argv[i])
+            if options.sample_rate < 0:
+                return usage()
+            i += 1
+        elif arg.startswith("-"):
+            return usage()
+        else:
+            paths.append(arg)
+
+    if (options.profile or options.profile_calls) and not profiler.PROFILING_ENABLED:
+        print "This build cannot profile, translate it with --profiling"
+        return 64
 
-    if len(argv) == 1:
-        repl()
-    elif len(argv) == 2:
-        run_file(argv[1])
+    if len(paths) == 0:
+        repl(options)
+    elif len(paths) == 1:
+        return run_file(paths[0], options)
     else:
-        print "Usage: lox [path]"
-        raise SystemExit(64)
+        return usage()
 
     return 0
@@ -15,17 +15,21 @@ class Obj(object):
           return "UNREPRESENTABLE INSTANCE"
 
      def is_equal(self, other):
-          return False
+          return self is other
 
      def hash(self):
           return 0
 
 
 class ObjString(Obj):
-     def __init__(self, value):
+     _immutable_fields_ = ['buffer', 'length', 'interned']
+
+     def __init__(self, value, interned=False):
           self.type = ObjType.STRING
           self.buffer = value
           self.length = len(value)
+          self.interned = interned
+          self.hash_value = -1
 
      def __repr__(self):
           return self.repr()
@@ -34,7 +38,12 @@ class ObjString(Obj):
           return str(self.buffer)
 
      def is_equal(self, other):
-          if self.type != other.type:
+          if self is other:
+               return True
+          if not isinstance(other, ObjString):
+               return False
+          if self.interned and other.interned:
+               # Equal interned strings are always the same object
                return False
           return self.buffer == other.buffer
 
@@ -46,10 +55,16 @@ class ObjString(Obj):
           return ObjString(self.buffer + other.buffer)
 
      def hash(self):
-          return compute_hash(self.buffer)
+          hash_value = self.hash_value
+          if hash_value == -1:
+               hash_value = compute_hash(self.buffer)
+               self.hash_value = hash_value
+          return hash_value
 
 
 class ObjFunction(Obj):
+     _immutable_fields_ = ['arity', 'chunk', 'name']
+
      def __init__(self, chunk=None, name=None, arity=0):
           self.arity = arity
           self.chunk = chunk
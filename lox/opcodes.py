@@ -20,18 +20,204 @@ class OpCode:
     OP_JUMP = OP_JUMP_IF_FALSE + 1
     OP_LOOP = OP_JUMP + 1
     OP_POP = OP_LOOP + 1
-    OP_DEFINE_GLOBAL = OP_POP + 1
-    OP_GET_GLOBAL = OP_DEFINE_GLOBAL + 1
-    OP_SET_GLOBAL = OP_GET_GLOBAL + 1
-    OP_GET_LOCAL = OP_SET_GLOBAL + 1
+    OP_DEFINE_GLOBAL_SLOT = OP_POP + 1
+    OP_GET_GLOBAL_SLOT = OP_DEFINE_GLOBAL_SLOT + 1
+    OP_SET_GLOBAL_SLOT = OP_GET_GLOBAL_SLOT + 1
+    OP_GET_LOCAL = OP_SET_GLOBAL_SLOT + 1
     OP_SET_LOCAL = OP_GET_LOCAL + 1
     OP_CALL = OP_SET_LOCAL + 1
 
+    # Quickened forms of the generic instructions above, specialized to the
+    # operand types seen when the instruction last ran
+    OP_ADD_NUM = OP_CALL + 1
+    OP_ADD_STR = OP_ADD_NUM + 1
+    OP_SUBTRACT_NUM = OP_ADD_STR + 1
+    OP_MULTIPLY_NUM = OP_SUBTRACT_NUM + 1
+    OP_DIVIDE_NUM = OP_MULTIPLY_NUM + 1
+    OP_LESS_NUM = OP_DIVIDE_NUM + 1
+    OP_GREATER_NUM = OP_LESS_NUM + 1
+
+    # Superinstructions the compiler emits for common local-variable patterns
+    OP_GET_LOCAL_GET_LOCAL = OP_GREATER_NUM + 1  # push local a, push local b
+    OP_ADD_LOCAL_CONST = OP_GET_LOCAL_GET_LOCAL + 1  # push local a + constant k
+    OP_INCR_LOCAL = OP_ADD_LOCAL_CONST + 1  # local a = local a + constant k
+
+    OP_NOT_EQUAL = OP_INCR_LOCAL + 1
+    OP_LESS_EQUAL = OP_NOT_EQUAL + 1
+    OP_GREATER_EQUAL = OP_LESS_EQUAL + 1
+    OP_LESS_EQUAL_NUM = OP_GREATER_EQUAL + 1
+    OP_GREATER_EQUAL_NUM = OP_LESS_EQUAL_NUM + 1
+
+    # Conditional jumps that consume their condition. The fused forms compare
+    # the two operands on top of the stack and jump when the comparison the
+    # compiler saw is false, so conditions never materialize a boolean.
+    OP_POP_JUMP_IF_FALSE = OP_GREATER_EQUAL_NUM + 1
+    OP_JUMP_IF_NOT_EQUAL = OP_POP_JUMP_IF_FALSE + 1
+    OP_JUMP_IF_EQUAL = OP_JUMP_IF_NOT_EQUAL + 1
+    OP_JUMP_IF_NOT_LESS = OP_JUMP_IF_EQUAL + 1
+    OP_JUMP_IF_NOT_LESS_EQUAL = OP_JUMP_IF_NOT_LESS + 1
+    OP_JUMP_IF_NOT_GREATER = OP_JUMP_IF_NOT_LESS_EQUAL + 1
+    OP_JUMP_IF_NOT_GREATER_EQUAL = OP_JUMP_IF_NOT_GREATER + 1
+
+    # Backward conditional jumps closing a rotated loop. They jump back to
+    # the start of the body when the condition holds and fall out of the
+    # loop otherwise.
+    OP_POP_LOOP_IF_TRUE = OP_JUMP_IF_NOT_GREATER_EQUAL + 1
+    OP_LOOP_IF_EQUAL = OP_POP_LOOP_IF_TRUE + 1
+    OP_LOOP_IF_NOT_EQUAL = OP_LOOP_IF_EQUAL + 1
+    OP_LOOP_IF_LESS = OP_LOOP_IF_NOT_EQUAL + 1
+    OP_LOOP_IF_LESS_EQUAL = OP_LOOP_IF_LESS + 1
+    OP_LOOP_IF_GREATER = OP_LOOP_IF_LESS_EQUAL + 1
+    OP_LOOP_IF_GREATER_EQUAL = OP_LOOP_IF_GREATER + 1
+
+    # Constant with a three byte pool index, for pools over 256 entries
+    OP_CONSTANT_LONG = OP_LOOP_IF_GREATER_EQUAL + 1
+    # Prefix doubling the operand width of the next instruction: two byte
+    # local and global slots, four byte jump offsets. See WideOps.
+    OP_WIDE = OP_CONSTANT_LONG + 1
+
     BinaryOps = [
         OP_ADD,
         OP_SUBTRACT,
         OP_MULTIPLY,
         OP_DIVIDE,
         OP_GREATER,
-        OP_LESS
+        OP_LESS,
+        OP_ADD_NUM,
+        OP_ADD_STR,
+        OP_SUBTRACT_NUM,
+        OP_MULTIPLY_NUM,
+        OP_DIVIDE_NUM,
+        OP_LESS_NUM,
+        OP_GREATER_NUM,
+        OP_LESS_EQUAL,
+        OP_GREATER_EQUAL,
+        OP_LESS_EQUAL_NUM,
+        OP_GREATER_EQUAL_NUM,
+    ]
+
+    # Comparison => compare-and-branch taken when the comparison is false
+    CompareBranchOps = {
+        OP_EQUAL: OP_JUMP_IF_NOT_EQUAL,
+        OP_NOT_EQUAL: OP_JUMP_IF_EQUAL,
+        OP_LESS: OP_JUMP_IF_NOT_LESS,
+        OP_LESS_EQUAL: OP_JUMP_IF_NOT_LESS_EQUAL,
+        OP_GREATER: OP_JUMP_IF_NOT_GREATER,
+        OP_GREATER_EQUAL: OP_JUMP_IF_NOT_GREATER_EQUAL,
+    }
+
+    # Comparison => backward compare-and-branch taken when it is true
+    CompareLoopOps = {
+        OP_EQUAL: OP_LOOP_IF_EQUAL,
+        OP_NOT_EQUAL: OP_LOOP_IF_NOT_EQUAL,
+        OP_LESS: OP_LOOP_IF_LESS,
+        OP_LESS_EQUAL: OP_LOOP_IF_LESS_EQUAL,
+        OP_GREATER: OP_LOOP_IF_GREATER,
+        OP_GREATER_EQUAL: OP_LOOP_IF_GREATER_EQUAL,
+    }
+
+    ByteOps = [
+        OP_CONSTANT,
+        OP_DEFINE_GLOBAL_SLOT,
+        OP_GET_GLOBAL_SLOT,
+        OP_SET_GLOBAL_SLOT,
+        OP_GET_LOCAL,
+        OP_SET_LOCAL,
+        OP_CALL,
+    ]
+
+    JumpOps = [
+        OP_JUMP_IF_FALSE,
+        OP_JUMP,
+        OP_LOOP,
+        OP_POP_JUMP_IF_FALSE,
+        OP_JUMP_IF_NOT_EQUAL,
+        OP_JUMP_IF_EQUAL,
+        OP_JUMP_IF_NOT_LESS,
+        OP_JUMP_IF_NOT_LESS_EQUAL,
+        OP_JUMP_IF_NOT_GREATER,
+        OP_JUMP_IF_NOT_GREATER_EQUAL,
+        OP_POP_LOOP_IF_TRUE,
+        OP_LOOP_IF_EQUAL,
+        OP_LOOP_IF_NOT_EQUAL,
+        OP_LOOP_IF_LESS,
+        OP_LOOP_IF_LESS_EQUAL,
+        OP_LOOP_IF_GREATER,
+        OP_LOOP_IF_GREATER_EQUAL,
+    ]
+
+    # Jumps whose offset is subtracted from the instruction pointer
+    BackwardJumpOps = [
+        OP_LOOP,
+        OP_POP_LOOP_IF_TRUE,
+        OP_LOOP_IF_EQUAL,
+        OP_LOOP_IF_NOT_EQUAL,
+        OP_LOOP_IF_LESS,
+        OP_LOOP_IF_LESS_EQUAL,
+        OP_LOOP_IF_GREATER,
+        OP_LOOP_IF_GREATER_EQUAL,
+    ]
+
+    # Instructions that may follow OP_WIDE
+    WideOps = JumpOps + [
+        OP_DEFINE_GLOBAL_SLOT,
+        OP_GET_GLOBAL_SLOT,
+        OP_SET_GLOBAL_SLOT,
+        OP_GET_LOCAL,
+        OP_SET_LOCAL,
     ]
+
+    ShortOps = JumpOps + [
+        OP_GET_LOCAL_GET_LOCAL,
+        OP_ADD_LOCAL_CONST,
+        OP_INCR_LOCAL,
+    ]
+
+
+def operand_size(opcode):
+    """Number of operand bytes that follow `opcode` in a chunk."""
+    if opcode in OpCode.ByteOps:
+        return 1
+    elif opcode in OpCode.ShortOps:
+        return 2
+    elif opcode == OpCode.OP_CONSTANT_LONG:
+        return 3
+    return 0
+
+
+def wide_operand_size(opcode):
+    """Number of operand bytes that follow `opcode` after an OP_WIDE."""
+    return 2 * operand_size(opcode)
+
+
+def instruction_size(code, offset):
+    """Size in bytes of the instruction at `offset`, prefix included."""
+    opcode = code[offset]
+    if opcode == OpCode.OP_WIDE:
+        return 2 + wide_operand_size(code[offset + 1])
+    return 1 + operand_size(opcode)
+
+
+def stack_effect(opcode, operand):
+    """Change in stack depth caused by running `opcode` with `operand`."""
+    if opcode in OpCode.BinaryOps:
+        return -1
+    elif (opcode == OpCode.OP_CONSTANT or opcode == OpCode.OP_CONSTANT_LONG
+            or opcode == OpCode.OP_NIL or opcode == OpCode.OP_TRUE
+            or opcode == OpCode.OP_FALSE or opcode == OpCode.OP_GET_GLOBAL_SLOT
+            or opcode == OpCode.OP_GET_LOCAL or opcode == OpCode.OP_ADD_LOCAL_CONST):
+        return 1
+    elif opcode == OpCode.OP_GET_LOCAL_GET_LOCAL:
+        return 2
+    elif (opcode == OpCode.OP_RETURN or opcode == OpCode.OP_EQUAL
+            or opcode == OpCode.OP_NOT_EQUAL or opcode == OpCode.OP_PRINT
+            or opcode == OpCode.OP_POP or opcode == OpCode.OP_DEFINE_GLOBAL_SLOT
+            or opcode == OpCode.OP_POP_JUMP_IF_FALSE
+            or opcode == OpCode.OP_POP_LOOP_IF_TRUE):
+        return -1
+    elif opcode in OpCode.CompareBranchOps.values() or opcode in OpCode.CompareLoopOps.values():
+        return -2
+    elif opcode == OpCode.OP_CALL:
+        # The callee and its arguments are replaced by the result
+        return -operand
+    return 0
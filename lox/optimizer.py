@@ -0,0 +1,457 @@
+from lox.object import ObjFunction
+from lox.opcodes import OpCode, operand_size, wide_operand_size, stack_effect
+from lox.value import ValueObj
+
+
+class Instruction(object):
+    """A decoded instruction. Jumps refer to their target instruction rather
+    than to a byte offset, so passes can add and remove code freely.
+
+    `arg1` is the operand, whatever its width; superinstructions keep their
+    second operand in `arg2`. `wide` marks an OP_WIDE prefix, which encode
+    adds to jumps by itself when their offset needs it."""
+
+    def __init__(self, opcode, arg1, arg2, line, wide=False):
+        self.opcode = opcode
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.line = line
+        self.wide = wide
+        self.target = None
+        self.index = 0
+        self.offset = 0
+        self.deleted = False
+
+    def is_jump(self):
+        return self.opcode in OpCode.JumpOps
+
+    def is_backward_jump(self):
+        return self.opcode in OpCode.BackwardJumpOps
+
+    def is_unconditional_jump(self):
+        return self.opcode == OpCode.OP_JUMP or self.opcode == OpCode.OP_LOOP
+
+    def falls_through(self):
+        return not (self.is_unconditional_jump() or self.opcode == OpCode.OP_RETURN)
+
+    def operand_width(self):
+        if self.wide:
+            return wide_operand_size(self.opcode)
+        return operand_size(self.opcode)
+
+    def size(self):
+        if self.wide:
+            return 2 + self.operand_width()
+        return 1 + self.operand_width()
+
+    def jump_distance(self):
+        target = self.target
+        assert target is not None
+        after = self.offset + self.size()
+        if self.is_backward_jump():
+            return after - target.offset
+        return target.offset - after
+
+
+def _has_two_operands(opcode):
+    return opcode in OpCode.ShortOps and opcode not in OpCode.JumpOps
+
+
+def _read_operand(chunk, offset, width):
+    value = 0
+    for i in range(width):
+        value = value << 8 | chunk.get_byte(offset + i)
+    return value
+
+
+def decode(chunk, long_jumps=None):
+    """Decode `chunk`. `long_jumps` maps the operand offset of forward jumps
+    whose operand could not hold their distance to their target offset."""
+    instructions = []
+    by_offset = {}
+    jump_offsets = []
+    offset = 0
+    while offset < chunk.get_count():
+        opcode = chunk.get_byte(offset)
+        wide = opcode == OpCode.OP_WIDE
+        operands = offset + 1
+        if wide:
+            opcode = chunk.get_byte(offset + 1)
+            operands = offset + 2
+
+        instruction = Instruction(opcode, -1, -1, chunk.get_line(offset), wide)
+        width = instruction.operand_width()
+        if _has_two_operands(opcode):
+            instruction.arg1 = chunk.get_byte(operands)
+            instruction.arg2 = chunk.get_byte(operands + 1)
+        elif width > 0:
+            instruction.arg1 = _read_operand(chunk, operands, width)
+
+        instruction.offset = offset
+        by_offset[offset] = instruction
+        instructions.append(instruction)
+        if instruction.is_jump():
+            jump_offsets.append(len(instructions) - 1)
+        offset += instruction.size()
+
+    for i in jump_offsets:
+        instruction = instructions[i]
+        operands = instruction.offset + 1
+        if long_jumps is not None and operands in long_jumps:
+            instruction.target = by_offset[long_jumps[operands]]
+            continue
+        after = instruction.offset + instruction.size()
+        if instruction.is_backward_jump():
+            instruction.target = by_offset[after - instruction.arg1]
+        else:
+            instruction.target = by_offset[after + instruction.arg1]
+
+    _renumber(instructions)
+    return instructions
+
+
+def max_stack_depth(chunk):
+    """The most values the code of `chunk` has on the stack at once, not
+    counting the callee and the arguments it starts with."""
+    instructions = decode(chunk)
+    if not instructions:
+        return 0
+    depths = [-1] * len(instructions)
+    depths[0] = 0
+    pending = [0]
+    highest = 0
+    while pending:
+        i = pending.pop()
+        instruction = instructions[i]
+        depth = depths[i] + stack_effect(instruction.opcode, instruction.arg1)
+        if depth > highest:
+            highest = depth
+        # Every path to an instruction arrives with the same depth, so each
+        # one only needs to be visited once
+        if instruction.target is not None and depths[instruction.target.index] == -1:
+            depths[instruction.target.index] = depth
+            pending.append(instruction.target.index)
+        if instruction.falls_through() and i + 1 < len(instructions) and depths[i + 1] == -1:
+            depths[i + 1] = depth
+            pending.append(i + 1)
+    return highest
+
+
+def _layout(instructions):
+    offset = 0
+    for instruction in instructions:
+        instruction.offset = offset
+        offset += instruction.size()
+
+
+def encode(chunk, instructions):
+    # Start with short jumps and widen the ones that do not fit until
+    # nothing changes. Widening only ever makes distances longer.
+    for instruction in instructions:
+        if instruction.is_jump():
+            instruction.wide = False
+    while True:
+        _layout(instructions)
+        changed = False
+        for instruction in instructions:
+            if (instruction.is_jump() and not instruction.wide
+                    and instruction.jump_distance() > 0xffff):
+                instruction.wide = True
+                changed = True
+        if not changed:
+            break
+
+    chunk.truncate(0)
+    for instruction in instructions:
+        line = instruction.line
+        if instruction.wide:
+            chunk.write_chunk(OpCode.OP_WIDE, line)
+        chunk.write_chunk(instruction.opcode, line)
+
+        width = instruction.operand_width()
+        if _has_two_operands(instruction.opcode):
+            chunk.write_chunk(instruction.arg1, line)
+            chunk.write_chunk(instruction.arg2, line)
+            continue
+        elif instruction.is_jump():
+            operand = instruction.jump_distance()
+            assert operand >= 0
+        else:
+            operand = instruction.arg1
+        for i in range(width):
+            chunk.write_chunk((operand >> (8 * (width - 1 - i))) & 0xff, line)
+
+
+def assemble(chunk, long_jumps):
+    """Re-encode `chunk`, giving the jumps in `long_jumps` (see decode) the
+    wide operands they need."""
+    encode(chunk, decode(chunk, long_jumps))
+
+
+def _renumber(instructions):
+    for i in range(len(instructions)):
+        instructions[i].index = i
+
+
+def _live_target(instructions, target):
+    i = target.index
+    while instructions[i].deleted:
+        i += 1
+    return instructions[i]
+
+
+def compact(instructions):
+    """Drop deleted instructions, moving jumps that landed on them to the
+    next instruction that survives."""
+    for instruction in instructions:
+        if not instruction.deleted and instruction.target is not None:
+            instruction.target = _live_target(instructions, instruction.target)
+    live = [instruction for instruction in instructions if not instruction.deleted]
+    _renumber(live)
+    return live
+
+
+class BasicBlock(object):
+    """A run of instructions that is only entered at its first one and only
+    left after its last one. `start` and `end` are instruction indices, end
+    exclusive."""
+
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.successors = []
+
+
+class ControlFlowGraph(object):
+    """The basic blocks of a decoded chunk and the edges between them.
+
+    A block starts at the entry, at every jump target and after every jump
+    or return. Its successors are the block its last instruction jumps to
+    and, unless that is an unconditional jump or a return, the block after
+    it. Passes mark instructions as deleted instead of changing the
+    graph; it is built anew after they are compacted away."""
+
+    def __init__(self, instructions):
+        self.instructions = instructions
+        count = len(instructions)
+        leaders = [False] * count
+        if count > 0:
+            leaders[0] = True
+        for instruction in instructions:
+            if instruction.target is not None:
+                leaders[instruction.target.index] = True
+            if instruction.target is not None or not instruction.falls_through():
+                if instruction.index + 1 < count:
+                    leaders[instruction.index + 1] = True
+
+        self.blocks = []
+        self.block_of = [0] * count
+        for i in range(count):
+            if leaders[i]:
+                if self.blocks:
+                    self.blocks[-1].end = i
+                self.blocks.append(BasicBlock(len(self.blocks), i, count))
+            self.block_of[i] = len(self.blocks) - 1
+
+        for block in self.blocks:
+            last = self.last(block)
+            if last.target is not None:
+                block.successors.append(self.block_at(last.target))
+            if last.falls_through() and block.index + 1 < len(self.blocks):
+                block.successors.append(self.blocks[block.index + 1])
+
+    def block_at(self, instruction):
+        return self.blocks[self.block_of[instruction.index]]
+
+    def first(self, block):
+        return self.instructions[block.start]
+
+    def last(self, block):
+        return self.instructions[block.end - 1]
+
+
+class OptimizationPass(object):
+    name = "pass"
+
+    def run(self, cfg):
+        """Rewrite the instructions of `cfg` in place, marking removed ones
+        as deleted. Returns True if anything changed."""
+        raise NotImplementedError()
+
+
+class ThreadJumps(OptimizationPass):
+    """Retarget jumps that land on an unconditional jump to where that jump
+    goes, and turn jumps to a return into the return itself."""
+    name = "thread-jumps"
+
+    MAX_CHAIN = 16
+
+    def run(self, cfg):
+        changed = False
+        for block in cfg.blocks:
+            instruction = cfg.last(block)
+            if not instruction.is_jump():
+                continue
+
+            # Jumps land on the first instruction of a block, so a chain is
+            # a run of blocks that start with an unconditional jump
+            target = instruction.target
+            chain = 0
+            while target.is_unconditional_jump() and target is not instruction and chain < self.MAX_CHAIN:
+                target = target.target
+                chain += 1
+
+            if instruction.opcode == OpCode.OP_JUMP and target.opcode == OpCode.OP_RETURN:
+                instruction.opcode = OpCode.OP_RETURN
+                instruction.wide = False
+                instruction.arg1 = -1
+                instruction.arg2 = -1
+                instruction.target = None
+                changed = True
+                continue
+
+            if target is instruction.target:
+                continue
+            forward = target.index > instruction.index
+            if instruction.is_unconditional_jump():
+                instruction.opcode = OpCode.OP_JUMP if forward else OpCode.OP_LOOP
+            elif forward == instruction.is_backward_jump():
+                # Conditional jumps only come in one direction each
+                continue
+            instruction.target = target
+            changed = True
+        return changed
+
+
+class RemoveJumpsToNext(OptimizationPass):
+    """Remove unconditional jumps to the instruction right after them."""
+    name = "remove-jumps-to-next"
+
+    def run(self, cfg):
+        changed = False
+        for block in cfg.blocks:
+            instruction = cfg.last(block)
+            if (instruction.opcode == OpCode.OP_JUMP
+                    and instruction.target.index == block.end):
+                instruction.deleted = True
+                changed = True
+        return changed
+
+
+class RemoveUnreachable(OptimizationPass):
+    """Remove instructions that no path from the entry reaches."""
+    name = "remove-unreachable"
+
+    def run(self, cfg):
+        if not cfg.blocks:
+            return False
+        reachable = [False] * len(cfg.blocks)
+        reachable[0] = True
+        pending = [cfg.blocks[0]]
+        while pending:
+            block = pending.pop()
+            for successor in block.successors:
+                if not reachable[successor.index]:
+                    reachable[successor.index] = True
+                    pending.append(successor)
+
+        changed = False
+        for block in cfg.blocks:
+            if reachable[block.index]:
+                continue
+            for i in range(block.start, block.end):
+                cfg.instructions[i].deleted = True
+            changed = True
+        return changed
+
+
+class RemovePushPop(OptimizationPass):
+    """Remove side-effect free pushes whose value is popped right away."""
+    name = "remove-push-pop"
+
+    PURE_PUSHES = [
+        OpCode.OP_CONSTANT,
+        OpCode.OP_CONSTANT_LONG,
+        OpCode.OP_NIL,
+        OpCode.OP_TRUE,
+        OpCode.OP_FALSE,
+        OpCode.OP_GET_LOCAL,
+    ]
+
+    def run(self, cfg):
+        instructions = cfg.instructions
+        changed = False
+        for block in cfg.blocks:
+            # Only pairs within one block: no jump lands on the pop
+            for i in range(block.start, block.end - 1):
+                push = instructions[i]
+                pop = instructions[i + 1]
+                if (push.opcode in self.PURE_PUSHES and not push.deleted
+                        and pop.opcode == OpCode.OP_POP):
+                    # A jump may land on the push: it then falls through to
+                    # whatever follows the pop, which is the same thing
+                    push.deleted = True
+                    pop.deleted = True
+                    changed = True
+        return changed
+
+
+class PassManager(object):
+    """Runs a pipeline of passes over finished chunks.
+
+    Each function's chunk is decoded once and split into basic blocks, every
+    pass runs over that control flow graph, and the result is encoded back
+    with jump offsets and the line table rebuilt to match. The graph is
+    rebuilt whenever a pass changed the code.
+    """
+
+    # Safety net for pipelines that keep enabling each other
+    MAX_ROUNDS = 8
+
+    def __init__(self, passes, until_fixpoint=False, debug_print=False):
+        self.passes = passes
+        self.until_fixpoint = until_fixpoint
+        self.debug_print = debug_print
+
+    def run(self, function):
+        chunk = function.chunk
+        for i in range(chunk.constant_count()):
+            w_x = chunk.get_constant(i)
+            if isinstance(w_x, ValueObj):
+                obj = w_x.get_value()
+                if isinstance(obj, ObjFunction):
+                    self.run(obj)
+
+        instructions = decode(chunk)
+        cfg = ControlFlowGraph(instructions)
+        rounds = 0
+        while rounds < self.MAX_ROUNDS:
+            rounds += 1
+            changed = False
+            for optimization_pass in self.passes:
+                if optimization_pass.run(cfg):
+                    instructions = compact(instructions)
+                    cfg = ControlFlowGraph(instructions)
+                    changed = True
+            if not (changed and self.until_fixpoint):
+                break
+        encode(chunk, instructions)
+
+        if self.debug_print:
+            chunk.disassemble("%s (optimized)" % function.name)
+
+
+def make_pass_manager(level, debug_print=False):
+    """The pipeline for optimization level `level`, or None for level 0.
+
+    -O1 runs every pass once, -O2 repeats them until nothing changes."""
+    if level <= 0:
+        return None
+    passes = [
+        ThreadJumps(),
+        RemoveJumpsToNext(),
+        RemoveUnreachable(),
+        RemovePushPop(),
+    ]
+    return PassManager(passes, until_fixpoint=level >= 2, debug_print=debug_print)
@@ -0,0 +1,331 @@
+"""Profiles for --profile and --profile-calls.
+
+The instruction profile counts how often each opcode runs and how often
+each source line of each function runs. The call profile times every
+call and records who called whom. Both are reported when the script ends,
+as text or in a format other tools read.
+
+The hooks in VM.run and VM._call sit behind PROFILING_ENABLED, which the
+translation target turns off unless the build asks for profiling, so
+other builds do not even test whether a profile is active.
+"""
+import os
+import time
+
+from lox.debug import OpCodeToInstructionName, get_instruction_name, leftpad_string
+
+from rpython.rlib import jit
+from rpython.rlib.listsort import make_timsort_class
+from rpython.rlib.rfloat import formatd
+from rpython.rlib.rstring import StringBuilder
+
+# Untranslated runs always can profile; see target() in targetlox.py
+PROFILING_ENABLED = True
+
+OPCODE_COUNT = len(OpCodeToInstructionName)
+REPORT_LINES = 20
+
+
+class Count(object):
+    """A report entry: an opcode, or a line of the function `name`."""
+
+    def __init__(self, name, number, count):
+        self.name = name
+        self.number = number
+        self.count = count
+
+
+def _more_often(a, b):
+    return a.count > b.count
+
+
+CountSort = make_timsort_class(lt=_more_often)
+
+
+class FunctionCounts(object):
+    """Times each instruction of one function ran, by code offset."""
+
+    def __init__(self, function):
+        self.function = function
+        self.counts = [0] * len(function.chunk.code)
+
+
+class InstructionProfile(object):
+    def __init__(self):
+        self.opcode_counts = [0] * OPCODE_COUNT
+        self.functions = {}
+        self.function_list = []
+        self.last = None
+        self.total = 0
+
+    @jit.dont_look_inside
+    def count(self, function, offset, opcode):
+        self.total += 1
+        self.opcode_counts[opcode] += 1
+        counts = self.last
+        if counts is None or counts.function is not function:
+            counts = self.functions.get(function, None)
+            if counts is None:
+                counts = FunctionCounts(function)
+                self.functions[function] = counts
+                self.function_list.append(counts)
+            self.last = counts
+        counts.counts[offset] += 1
+
+    def line_counts(self):
+        """Executed instructions per function and source line, most first."""
+        result = []
+        for counts in self.function_list:
+            chunk = counts.function.chunk
+            by_line = {}
+            lines = []
+            for offset in range(len(counts.counts)):
+                if counts.counts[offset] == 0:
+                    continue
+                line = chunk.get_line(offset)
+                if line not in by_line:
+                    by_line[line] = 0
+                    lines.append(line)
+                by_line[line] += counts.counts[offset]
+            for line in lines:
+                result.append(Count(counts.function.name, line, by_line[line]))
+        CountSort(result).sort()
+        return result
+
+    def opcode_order(self):
+        """Opcodes that ran, most first."""
+        order = []
+        for opcode in range(OPCODE_COUNT):
+            if self.opcode_counts[opcode] > 0:
+                order.append(Count("", opcode, self.opcode_counts[opcode]))
+        CountSort(order).sort()
+        return [entry.number for entry in order]
+
+    def print_report(self):
+        print "Instruction profile: %d instructions" % self.total
+        self._print_row("count", "%", "opcode")
+        for opcode in self.opcode_order():
+            count = self.opcode_counts[opcode]
+            self._print_row("%d" % count, self._percent(count),
+                            get_instruction_name(opcode))
+        lines = self.line_counts()
+        self._print_row("count", "%", "line")
+        for i in range(min(len(lines), REPORT_LINES)):
+            entry = lines[i]
+            self._print_row("%d" % entry.count, self._percent(entry.count),
+                            "%s:%d" % (entry.name, entry.number))
+
+    def _print_row(self, count, percent, name):
+        print "  %s %s  %s" % (leftpad_string(count, 12), leftpad_string(percent, 7), name)
+
+    def to_json(self):
+        builder = StringBuilder()
+        builder.append('{"instructions": %d, "opcodes": {' % self.total)
+        first = True
+        for opcode in self.opcode_order():
+            if not first:
+                builder.append(', ')
+            first = False
+            builder.append('"%s": %d' % (get_instruction_name(opcode),
+                                         self.opcode_counts[opcode]))
+        builder.append('}, "lines": [')
+        first = True
+        for entry in self.line_counts():
+            if not first:
+                builder.append(', ')
+            first = False
+            builder.append('{"function": "%s", "line": %d, "count": %d}' % (
+                entry.name, entry.number, entry.count))
+        builder.append(']}\n')
+        return builder.build()
+
+    def write_json(self, path):
+        """Write the profile to `path`. Returns False if that fails."""
+        return write_file(path, self.to_json())
+
+    def _percent(self, count):
+        if self.total == 0:
+            return "0.00"
+        return formatd(100.0 * count / self.total, 'f', 2)
+
+
+class CallEdge(object):
+    """Calls from one function to another."""
+
+    def __init__(self, callee, line):
+        self.callee = callee
+        # Line of the first call seen, in the caller
+        self.line = line
+        self.calls = 0
+        # Time in the callee, for calls that are not recursive
+        self.inclusive = 0.0
+
+
+class FunctionTimes(object):
+    def __init__(self, function, filename):
+        self.function = function
+        self.label = "%s:%d(%s)" % (filename, function.chunk.get_line(0), function.name)
+        self.calls = 0
+        # Time from entering to leaving, counted once for recursive calls
+        self.inclusive = 0.0
+        # The same, less the time spent in the functions it called
+        self.exclusive = 0.0
+        self.active = 0
+        self.edges = {}
+        self.edge_list = []
+
+    def edge_to(self, callee, ip):
+        edge = self.edges.get(callee, None)
+        if edge is None:
+            edge = CallEdge(callee, self.function.chunk.get_line(ip - 1))
+            self.edges[callee] = edge
+            self.edge_list.append(edge)
+        return edge
+
+
+class Activation(object):
+    def __init__(self, times, edge, start):
+        self.times = times
+        self.edge = edge
+        self.start = start
+        self.children = 0.0
+
+
+def _more_exclusive(a, b):
+    return a.exclusive > b.exclusive
+
+
+TimesSort = make_timsort_class(lt=_more_exclusive)
+
+
+class CallProfile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.functions = {}
+        self.function_list = []
+        self.stack = []
+        self.total_calls = 0
+
+    @jit.dont_look_inside
+    def enter(self, function, caller_ip):
+        """`function` is being called, from the instruction before
+        `caller_ip` in the function running now."""
+        times = self.functions.get(function, None)
+        if times is None:
+            times = FunctionTimes(function, self.filename)
+            self.functions[function] = times
+            self.function_list.append(times)
+        edge = None
+        if self.stack:
+            edge = self.stack[-1].times.edge_to(times, caller_ip)
+            edge.calls += 1
+        times.calls += 1
+        times.active += 1
+        self.total_calls += 1
+        self.stack.append(Activation(times, edge, time.time()))
+
+    @jit.dont_look_inside
+    def leave(self):
+        activation = self.stack.pop()
+        elapsed = time.time() - activation.start
+        times = activation.times
+        times.exclusive += elapsed - activation.children
+        times.active -= 1
+        if times.active == 0:
+            # Like pstats, count cumulative time only for calls that are
+            # not inside another call of the same function
+            times.inclusive += elapsed
+            if activation.edge is not None:
+                activation.edge.inclusive += elapsed
+        if self.stack:
+            self.stack[-1].children += elapsed
+
+    def by_exclusive_time(self):
+        result = [times for times in self.function_list]
+        TimesSort(result).sort()
+        return result
+
+    def total_time(self):
+        total = 0.0
+        for times in self.function_list:
+            total += times.exclusive
+        return total
+
+    def print_report(self):
+        """Print a table like Python's pstats module, with the time per
+        call in microseconds, and the call graph."""
+        print "Call profile: %d calls in %s seconds" % (self.total_calls,
+                                                      _format_time(self.total_time()))
+        print "  %s %s %s %s %s  %s" % (
+            leftpad_string("ncalls", 10), leftpad_string("tottime", 10),
+            leftpad_string("us/call", 10), leftpad_string("cumtime", 10),
+            leftpad_string("us/call", 10), "function")
+        functions = self.by_exclusive_time()
+        for times in functions:
+            print "  %s %s %s %s %s  %s" % (
+                leftpad_string("%d" % times.calls, 10),
+                leftpad_string(_format_time(times.exclusive), 10),
+                leftpad_string(_per_call(times.exclusive, times.calls), 10),
+                leftpad_string(_format_time(times.inclusive), 10),
+                leftpad_string(_per_call(times.inclusive, times.calls), 10),
+                times.label)
+        print "  Call graph: caller -> callee  calls  cumtime"
+        for times in functions:
+            for edge in times.edge_list:
+                print "  %s -> %s  %d  %s" % (times.label, edge.callee.label,
+                                              edge.calls, _format_time(edge.inclusive))
+
+    def to_callgrind(self):
+        """The profile in the callgrind format KCachegrind and
+        callgrind_annotate read, with costs in microseconds."""
+        builder = StringBuilder()
+        builder.append("# callgrind format\n")
+        builder.append("version: 1\n")
+        builder.append("creator: rlox\n")
+        builder.append("positions: line\n")
+        builder.append("events: Microseconds\n")
+        builder.append("summary: %d\n" % _microseconds(self.total_time()))
+        for times in self.function_list:
+            builder.append("\nfl=%s\n" % self.filename)
+            builder.append("fn=%s\n" % times.label)
+            builder.append("%d %d\n" % (times.function.chunk.get_line(0),
+                                         _microseconds(times.exclusive)))
+            for edge in times.edge_list:
+                builder.append("cfn=%s\n" % edge.callee.label)
+                builder.append("calls=%d %d\n" % (edge.calls,
+                                                   edge.callee.function.chunk.get_line(0)))
+                builder.append("%d %d\n" % (edge.line, _microseconds(edge.inclusive)))
+        return builder.build()
+
+    def write_callgrind(self, path):
+        """Write the profile to `path`. Returns False if that fails."""
+        return write_file(path, self.to_callgrind())
+
+
+def _format_time(seconds):
+    return formatd(seconds, 'f', 3)
+
+
+def _per_call(seconds, calls):
+    return formatd(seconds * 1000000.0 / calls, 'f', 3)
+
+
+def _microseconds(seconds):
+    return int(seconds * 1000000.0)
+
+
+def write_file(path, data):
+    """Write `data` to `path`. Returns False if that fails."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    except OSError:
+        return False
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+    except OSError:
+        os.close(fd)
+        return False
+    os.close(fd)
+    return True
@@ -0,0 +1,112 @@
+"""Sampling profiler for --sample.
+
+Every so often the VM records the Lox call stack, with the line each frame
+is on. At exit the samples are written in the folded format that
+flamegraph.pl and speedscope read: one line per distinct stack, frames from
+the outermost in, separated by semicolons, then the number of samples.
+
+Unlike the profiles in lox/profiler.py this is part of every build, cheap
+enough to turn on for production runs. The VM does not read the clock on
+every instruction: calls and loop back-edges count down a tick counter,
+and only when it runs out is the clock checked. The counter's length adapts
+so that happens a few times per sample interval. The sampler sits in a
+quasi-immutable field, so when sampling is off the JIT drops the check
+from its traces altogether.
+"""
+import time
+
+from lox.profiler import write_file
+
+from rpython.rlib import jit
+
+DEFAULT_RATE = 1000
+# Bounds for the average number of ticks between two looks at the clock
+MIN_TICKS_PER_CHECK = 16
+MAX_TICKS_PER_CHECK = 1 << 20
+
+
+class Sampler(object):
+    def __init__(self, path, rate):
+        self.path = path
+        self.interval = 1.0 / rate
+        self.last_check = time.time()
+        self.next_sample = self.last_check + self.interval
+        self.seed = 1
+        self.ticks_per_check = MIN_TICKS_PER_CHECK
+        self.countdown = MIN_TICKS_PER_CHECK
+        self.counts = {}
+        self.stacks = []
+        self.samples = 0
+
+    def tick(self, frame):
+        self.countdown -= 1
+        # Only an actual sample looks at the frames. Under the JIT, that
+        # forces every virtual frame on the stack into existence; the clock
+        # check that comes far more often must not.
+        if self.countdown <= 0 and self.sample_due():
+            self.record(frame)
+
+    @jit.dont_look_inside
+    def sample_due(self):
+        now = time.time()
+        # Aim for a few clock checks per sample interval, however fast the
+        # program ticks. Every check is a failing guard in compiled code.
+        elapsed = now - self.last_check
+        self.last_check = now
+        if elapsed * 8 < self.interval and self.ticks_per_check < MAX_TICKS_PER_CHECK:
+            self.ticks_per_check *= 2
+        elif elapsed * 2 > self.interval and self.ticks_per_check > MIN_TICKS_PER_CHECK:
+            self.ticks_per_check /= 2
+        # Programs tick in short repeating patterns, one per loop iteration.
+        # A fixed countdown would keep checking at the same point of the
+        # pattern and sample nothing else, so its length is random.
+        self.seed = (self.seed * 1103515245 + 12345) & 0x7fffffff
+        self.countdown = 1 + self.seed % (2 * self.ticks_per_check)
+        if now < self.next_sample:
+            return False
+        self.next_sample = now + self.interval
+        return True
+
+    @jit.dont_look_inside
+    def record(self, frame):
+        # Ticks come right before `frame` runs the instruction at its ip;
+        # its callers are each in the middle of the call before theirs.
+        names = [_frame_name(frame, frame.ip)]
+        frame = frame.caller
+        while frame is not None:
+            names.append(_frame_name(frame, frame.ip - 1))
+            frame = frame.caller
+        names.reverse()
+        stack = ";".join(names)
+        if stack not in self.counts:
+            self.counts[stack] = 0
+            self.stacks.append(stack)
+        self.counts[stack] += 1
+        self.samples += 1
+
+    def folded(self):
+        lines = ["%s %d\n" % (stack, self.counts[stack]) for stack in self.stacks]
+        return "".join(lines)
+
+    def write(self):
+        """Write the samples to the output path. Returns False if that
+        fails."""
+        return write_file(self.path, self.folded())
+
+
+def _frame_name(frame, ip):
+    return "%s:%d" % (frame.function.name, frame.function.chunk.get_line(ip))
+
+
+class SamplingState(object):
+    _immutable_fields_ = ['sampler?']
+
+    def __init__(self):
+        self.sampler = None
+
+
+state = SamplingState()
+
+
+def start(path, rate):
+    state.sampler = Sampler(path, rate)
@@ -1,4 +1,5 @@
 from rpython.rlib import jit
+from rpython.rlib.objectmodel import newlist_hint
 
 class TokenTypes(object):
     # Single-character tokens
@@ -55,8 +56,45 @@ TokenTypeToTokenName = {getattr(TokenTypes, token_type):
                          token_type for token_type in dir(TokenTypes) if not token_type.startswith("__")}
 
 
+# Character classes, indexed by character code. Identifiers start with a
+# letter or underscore; the scanner checks a character's class with one
+# list lookup instead of str.isalpha() and str.isdigit().
+CHAR_OTHER = 0
+CHAR_ALPHA = 1
+CHAR_DIGIT = 2
+CHAR_SPACE = 3
+
+
+def _char_class(code):
+    char = chr(code)
+    if 'a' <= char <= 'z' or 'A' <= char <= 'Z' or char == '_':
+        return CHAR_ALPHA
+    if '0' <= char <= '9':
+        return CHAR_DIGIT
+    if char in ' \r\t':
+        return CHAR_SPACE
+    return CHAR_OTHER
+
+
+CHAR_CLASSES = [_char_class(code) for code in range(256)]
+
+# The token of every character that is a token by itself, or NO_TOKEN
+NO_TOKEN = -1
+SINGLE_CHAR_TOKENS = [NO_TOKEN] * 256
+for _char, _type in [('(', TokenTypes.LEFT_PAREN), (')', TokenTypes.RIGHT_PAREN),
+                     ('{', TokenTypes.LEFT_BRACE), ('}', TokenTypes.RIGHT_BRACE),
+                     (';', TokenTypes.SEMICOLON), (',', TokenTypes.COMMA),
+                     ('.', TokenTypes.DOT), ('-', TokenTypes.MINUS),
+                     ('+', TokenTypes.PLUS), ('/', TokenTypes.SLASH),
+                     ('*', TokenTypes.STAR)]:
+    SINGLE_CHAR_TOKENS[ord(_char)] = _type
+
+
 def debug_token(token):
-    token_type = token.type
+    return debug_token_type(token.type)
+
+
+def debug_token_type(token_type):
     return TokenTypeToTokenName[token_type]
 
 
@@ -81,70 +119,186 @@ class ErrorToken(BaseToken):
         self.line = line
 
 
+class TokenStream(object):
+    """All tokens of a source, packed into parallel lists: token i has type
+    types[i], is lengths[i] characters from starts[i] on, and ends on line
+    lines[i]. Error tokens have their message in `messages` instead.
+
+    Identifiers are interned as they are added: name_ids[i] numbers the
+    name of identifier token i, the same number for every occurrence, and
+    names holds the names by number. Other tokens have -1. Names are looked
+    up in an open addressing table by a hash of their characters in the
+    source, so only the first occurrence of a name is sliced out of it."""
+
+    INITIAL_TABLE_SIZE = 64
+
+    def __init__(self, source):
+        self.source = source
+        # Typical code has a token every four characters or so. Reserving
+        # that much up front saves growing these lists over and over.
+        hint = len(source) / 4
+        self.types = newlist_hint(hint)
+        self.starts = newlist_hint(hint)
+        self.lengths = newlist_hint(hint)
+        self.lines = newlist_hint(hint)
+        self.name_ids = newlist_hint(hint)
+        self.messages = {}
+        self.names = []
+        self.name_hashes = []
+        # Name numbers by hash, -1 for empty entries. At most half full.
+        self.name_table = [-1] * self.INITIAL_TABLE_SIZE
+
+    def add(self, token_type, start, length, line):
+        name_id = -1
+        if token_type == TokenTypes.IDENTIFIER:
+            name_id = self._intern(start, length)
+        self.types.append(token_type)
+        self.starts.append(start)
+        self.lengths.append(length)
+        self.lines.append(line)
+        self.name_ids.append(name_id)
+
+    def _intern(self, start, length):
+        source = self.source
+        name_hash = length
+        for i in range(start, start + length):
+            name_hash = (name_hash * 31 + ord(source[i])) & 0xffffff
+
+        mask = len(self.name_table) - 1
+        index = name_hash & mask
+        while True:
+            number = self.name_table[index]
+            if number == -1:
+                break
+            if (self.name_hashes[number] == name_hash
+                    and self._name_equal(self.names[number], start, length)):
+                return number
+            index = (index + 1) & mask
+
+        end = start + length
+        assert start >= 0
+        assert end >= start
+        number = len(self.names)
+        self.names.append(source[start:end])
+        self.name_hashes.append(name_hash)
+        self.name_table[index] = number
+        if len(self.names) * 2 > len(self.name_table):
+            self._grow_name_table()
+        return number
+
+    def _name_equal(self, name, start, length):
+        if len(name) != length:
+            return False
+        source = self.source
+        for i in range(length):
+            if name[i] != source[start + i]:
+                return False
+        return True
+
+    def _grow_name_table(self):
+        table = [-1] * (len(self.name_table) * 2)
+        mask = len(table) - 1
+        for number in range(len(self.names)):
+            index = self.name_hashes[number] & mask
+            while table[index] != -1:
+                index = (index + 1) & mask
+            table[index] = number
+        self.name_table = table
+
+    def add_error(self, message, line):
+        self.messages[len(self.types)] = message
+        self.add(TokenTypes.ERROR, 0, 0, line)
+
+    def last(self):
+        return len(self.types) - 1
+
+    def type_at(self, index):
+        return self.types[index]
+
+    def line_at(self, index):
+        return self.lines[index]
+
+    def string_at(self, index):
+        """The text of token `index`, or the message of an error token."""
+        if self.types[index] == TokenTypes.ERROR:
+            return self.messages[index]
+        start = self.starts[index]
+        end = start + self.lengths[index]
+        assert start >= 0
+        assert end >= start
+        return self.source[start:end]
+
+    def name_id(self, index):
+        return self.name_ids[index]
+
+    def name_at(self, index):
+        """The interned name of identifier token `index`. Other tokens only
+        get here after a parse error, and give their text."""
+        name_id = self.name_ids[index]
+        if name_id == -1:
+            return self.string_at(index)
+        return self.names[name_id]
+
+
 class Scanner(object):
     def __init__(self, source):
         self.source = source
         self.start = 0
         self.current = 0
         self.line = 1
+        self.error_message = ""
+
+    def scan_all(self):
+        """Scan the whole source in one go, up to and including EOF."""
+        tokens = TokenStream(self.source)
+        while True:
+            token_type = self._scan()
+            if token_type == TokenTypes.ERROR:
+                tokens.add_error(self.error_message, self.line)
+            else:
+                tokens.add(token_type, self.start, self.current - self.start, self.line)
+                if token_type == TokenTypes.EOF:
+                    return tokens
 
     def scan_token(self):
+        token_type = self._scan()
+        if token_type == TokenTypes.ERROR:
+            return self.make_error_token(self.error_message)
+        return self.make_token(token_type)
+
+    def _scan(self):
+        """Scan the next token and return its type. It runs from self.start
+        to self.current; for an error, the message is in error_message."""
         self._skip_whitespace()
         self.start = self.current
 
         if self._is_at_end():
-            return self.make_token(TokenTypes.EOF)
+            return TokenTypes.EOF
 
         c = self.advance()
+        char_class = CHAR_CLASSES[ord(c)]
 
-        if c.isalpha():
+        if char_class == CHAR_ALPHA:
             return self._make_identifier()
 
-        if c.isdigit():
+        if char_class == CHAR_DIGIT:
             return self._number()
 
-        if c == '(':
-            return self.make_token(TokenTypes.LEFT_PAREN)
-        if c == ')':
-            return self.make_token(TokenTypes.RIGHT_PAREN)
-        if c == '{':
-            return self.make_token(TokenTypes.LEFT_BRACE)
-        if c == '}':
-            return self.make_token(TokenTypes.RIGHT_BRACE)
-        if c == ';':
-            return self.make_token(TokenTypes.SEMICOLON)
-        if c == ',':
-            return self.make_token(TokenTypes.COMMA)
-        if c == '.':
-            return self.make_token(TokenTypes.DOT)
-        if c == '-':
-            return self.make_token(TokenTypes.MINUS)
-        if c == '+':
-            return self.make_token(TokenTypes.PLUS)
-        if c == '/':
-            return self.make_token(TokenTypes.SLASH)
-        if c == '*':
-            return self.make_token(TokenTypes.STAR)
+        token_type = SINGLE_CHAR_TOKENS[ord(c)]
+        if token_type != NO_TOKEN:
+            return token_type
         if c ==  '!':
-            return self.make_token(
-                TokenTypes.BANG_EQUAL if self._match('=') else TokenTypes.BANG
-            )
+            return TokenTypes.BANG_EQUAL if self._match('=') else TokenTypes.BANG
         if c == '=':
-            return self.make_token(
-                TokenTypes.EQUAL_EQUAL if self._match('=') else TokenTypes.EQUAL
-            )
+            return TokenTypes.EQUAL_EQUAL if self._match('=') else TokenTypes.EQUAL
         if c == '<':
-            return self.make_token(
-                TokenTypes.LESS_EQUAL if self._match('=') else TokenTypes.LESS
-            )
+            return TokenTypes.LESS_EQUAL if self._match('=') else TokenTypes.LESS
         if c == '>':
-            return self.make_token(
-                TokenTypes.GREATER_EQUAL if self._match('=') else TokenTypes.GREATER
-            )
+            return TokenTypes.GREATER_EQUAL if self._match('=') else TokenTypes.GREATER
         if c == '"':
             return self.make_string()
 
-        return self.make_error_token("Unexpected character: %s" % (c))
+        return self._error("Unexpected character: %s" % (c))
 
     def advance(self):
         self.current += 1
@@ -164,8 +318,8 @@ class Scanner(object):
     def _skip_whitespace(self):
         while True:
             c = self._peek()
-            if c in ' \r\t':
-                self.advance()
+            if CHAR_CLASSES[ord(c)] == CHAR_SPACE:
+                self.current += 1
             elif c == '\n':
                 self.line += 1
                 self.advance()
@@ -189,22 +343,30 @@ class Scanner(object):
             return '\0'
         return self.source[self.current + 1]
 
+    def _peek_class(self):
+        if self.current == len(self.source):
+            return CHAR_OTHER
+        return CHAR_CLASSES[ord(self.source[self.current])]
+
     def _number(self):
-        while self._peek().isdigit():
-            self.advance()
+        while self._peek_class() == CHAR_DIGIT:
+            self.current += 1
 
         # Floating point
-        if self._peek() == '.' and self._peek_next().isdigit():
-            self.advance()
-            while self._peek().isdigit():
-                self.advance()
+        if self._peek() == '.' and CHAR_CLASSES[ord(self._peek_next())] == CHAR_DIGIT:
+            self.current += 1
+            while self._peek_class() == CHAR_DIGIT:
+                self.current += 1
 
-        return self.make_token(TokenTypes.NUMBER)
+        return TokenTypes.NUMBER
 
     def _make_identifier(self):
-        while self._peek().isalpha() or self._peek().isdigit():
-            self.advance()
-        return self.make_token(self._identifier())
+        while True:
+            char_class = self._peek_class()
+            if char_class != CHAR_ALPHA and char_class != CHAR_DIGIT:
+                break
+            self.current += 1
+        return self._identifier()
 
     def _identifier(self):
         char = self.source[self.start]
@@ -251,10 +413,15 @@ class Scanner(object):
         return TokenTypes.IDENTIFIER
 
     def _check_keyword(self, start, length, rest, type):
-        if self.source[self.start + start: self.start + start+ length] == rest:
-            return type
-        else:
+        # Compare in place: the identifier must be exactly the keyword,
+        # not just start with it
+        if self.current - self.start != start + length:
             return TokenTypes.IDENTIFIER
+        offset = self.start + start
+        for i in range(length):
+            if self.source[offset + i] != rest[i]:
+                return TokenTypes.IDENTIFIER
+        return type
 
     def make_string(self):
         while self._peek() != '"' and not self._is_at_end():
@@ -263,11 +430,15 @@ class Scanner(object):
             self.advance()
 
         if self._is_at_end():
-            return self.make_error_token("Unterminated string.")
+            return self._error("Unterminated string.")
 
         # The closing quote
         self.advance()
-        return self.make_token(TokenTypes.STRING)
+        return TokenTypes.STRING
+
+    def _error(self, message):
+        self.error_message = message
+        return TokenTypes.ERROR
 
     def make_token(self, token_type):
         return Token(
@@ -0,0 +1,87 @@
+from lox.object import ObjString
+
+from rpython.rlib import jit
+
+
+class GlobalCell(object):
+    """Storage for one global variable.
+
+    The value is quasi-immutable so that a trace reading a global folds it
+    into a constant and is only invalidated when the global is written.
+    Globals that keep being written (loop counters and the like) would
+    invalidate their traces over and over, so after a few writes the cell
+    switches to an ordinary mutable field for good.
+    """
+    _immutable_fields_ = ['name', 'w_value?', 'is_mutable?']
+
+    WRITES_BEFORE_MUTABLE = 4
+
+    def __init__(self, name):
+        self.name = name
+        self.w_value = None
+        self.w_mutable_value = None
+        self.is_mutable = False
+        self.writes = 0
+
+    def get(self):
+        if self.is_mutable:
+            return self.w_mutable_value
+        return self.w_value
+
+    def set(self, w_value):
+        if self.is_mutable:
+            self.w_mutable_value = w_value
+        elif self.writes < self.WRITES_BEFORE_MUTABLE:
+            self.writes += 1
+            self.w_value = w_value
+        else:
+            self.w_mutable_value = w_value
+            self.w_value = None
+            self.is_mutable = True
+
+    def is_defined(self):
+        return self.get() is not None
+
+
+class GlobalTable(object):
+    """Maps global variable names to stable slot indices.
+
+    The compiler asks for a slot once per name and emits it as the operand
+    of the OP_*_GLOBAL_SLOT instructions; the VM then reaches the cell by
+    index without hashing the name.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.cells = []
+
+    def slot_for(self, name):
+        slot = self.slots.get(name, -1)
+        if slot == -1:
+            slot = len(self.cells)
+            self.cells.append(GlobalCell(name))
+            self.slots[name] = slot
+        return slot
+
+    @jit.elidable
+    def get_cell(self, slot):
+        # Cells are only ever appended, so a slot always maps to the same cell
+        return self.cells[slot]
+
+
+class StringTable(object):
+    """Interns strings so that equal strings share one ObjString.
+
+    Interned strings compare by identity and compute their hash once.
+    """
+
+    def __init__(self):
+        self.strings = {}
+
+    def intern(self, buffer):
+        obj_str = self.strings.get(buffer, None)
+        if obj_str is None:
+            obj_str = ObjString(buffer, interned=True)
+            obj_str.hash()
+            self.strings[buffer] = obj_str
+        return obj_str
@@ -1,5 +1,9 @@
+import math
+
 from lox.object import ObjString
 
+from rpython.rlib import jit
+
 class ValueType:
     BOOL = 0
     NIL = 1
@@ -40,6 +44,9 @@ class Value(object):
     def as_number(self):
         raise NotImplementedError()
 
+    def is_equal(self, w_other):
+        raise NotImplementedError()
+
     def is_falsy(self):
         return isinstance(self, ValueNil) or isinstance(self, ValueBool) and (not self.as_bool())
 
@@ -61,8 +68,11 @@ class ValueArray(object):
         self.values.append(value)
         return len(self.values) - 1
 
+    def pop(self):
+        return self.values.pop()
+
 class ValueNil(Value):
-    _immutable_fields_ = ['value', 'value_type']
+    _immutable_fields_ = ['value_type']
 
     def __init__(self, value=None, value_type=ValueType.NIL):
         self.value_type = value_type
@@ -74,16 +84,19 @@ class ValueNil(Value):
         return self.value
 
     def as_bool(self):
-        return ValueBool(False)
+        return False
 
     def is_string(self):
         return False
 
+    def is_equal(self, w_other):
+        return w_other.is_nil()
+
     def negate(self):
         return self
 
 class ValueBool(Value):
-    _immutable_fields_ = ['value_type']
+    _immutable_fields_ = ['value', 'value_type']
 
     def __init__(self, value, value_type=ValueType.BOOL):
         self.value = value
@@ -108,11 +121,16 @@ class ValueBool(Value):
     def as_bool(self):
         return self.value
 
+    def is_equal(self, w_other):
+        if not isinstance(w_other, ValueBool):
+            return False
+        return self.value == w_other.value
+
     def negate(self):
-        return ValueBool(not self.value)
+        return wrap_bool(not self.value)
 
 class ValueNumber(Value):
-    _immutable_fields_ = ['value_type']
+    _immutable_fields_ = ['value', 'value_type']
 
     def __init__(self, value, value_type=ValueType.NUMBER):
         self.value = value
@@ -129,22 +147,22 @@ class ValueNumber(Value):
 
     def add(self, w_other):
         assert isinstance(w_other, ValueNumber)
-        return ValueNumber(self.value + w_other.value)
+        return wrap_number(self.value + w_other.value)
 
     def sub(self, w_other):
         assert isinstance(w_other, ValueNumber)
-        return ValueNumber(self.value - w_other.value)
+        return wrap_number(self.value - w_other.value)
 
     def mul(self, w_other):
         assert isinstance(w_other, ValueNumber)
-        return ValueNumber(self.value * w_other.value)
+        return wrap_number(self.value * w_other.value)
 
     def div(self, w_other):
         assert isinstance(w_other, ValueNumber)
-        return ValueNumber(self.value / w_other.value)
+        return wrap_number(self.value / w_other.value)
 
     def negate(self):
-        return ValueNumber(-self.value)
+        return wrap_number(-self.value)
 
     def as_number(self):
         return self.value
@@ -154,8 +172,13 @@ class ValueNumber(Value):
             return True
         return False
 
+    def is_equal(self, w_other):
+        if not isinstance(w_other, ValueNumber):
+            return False
+        return self.value == w_other.value
+
 class ValueObj(Value):
-    _immutable_fields_ = ['value_type']
+    _immutable_fields_ = ['obj', 'value_type']
 
     def __init__(self, obj, value_type=ValueType.OBJ):
         self.obj = obj
@@ -173,5 +196,42 @@ class ValueObj(Value):
     def is_string(self):
         return isinstance(self.obj, ObjString)
 
+    def is_equal(self, w_other):
+        if not isinstance(w_other, ValueObj):
+            return False
+        return self.obj.is_equal(w_other.obj)
+
     def negate(self):
         return self
+
+
+# nil, true and false are immutable, so every occurrence shares one instance
+w_nil = ValueNil()
+w_true = ValueBool(True)
+w_false = ValueBool(False)
+
+
+def wrap_bool(value):
+    if value:
+        return w_true
+    return w_false
+
+
+# Boxes for small integral numbers are preallocated and reused by the
+# interpreter. Traces skip the cache: a fresh ValueNumber that does not escape
+# is virtual and costs nothing there, while a cache lookup would add guards.
+USE_SMALL_NUMBER_CACHE = True
+SMALL_NUMBER_MIN = -128
+SMALL_NUMBER_MAX = 1023
+
+small_numbers = [ValueNumber(float(i))
+                 for i in range(SMALL_NUMBER_MIN, SMALL_NUMBER_MAX + 1)]
+
+
+def wrap_number(value):
+    if USE_SMALL_NUMBER_CACHE and not jit.we_are_jitted():
+        if SMALL_NUMBER_MIN <= value <= SMALL_NUMBER_MAX:
+            i = int(value)
+            if float(i) == value and not (i == 0 and math.copysign(1.0, value) < 0):
+                return small_numbers[i - SMALL_NUMBER_MIN]
+    return ValueNumber(value)
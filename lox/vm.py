@@ -1,21 +1,31 @@
 from lox.compiler import Compiler
 from lox.opcodes import OpCode
-from lox.debug import disassemble_instruction, format_line_number, get_printable_location
-from lox.value import ValueNil, ValueNumber, ValueBool, ValueNil, ValueObj, Value
+from lox.debug import disassemble_instruction, get_printable_location
+from lox.value import ValueNil, ValueNumber, ValueBool, ValueObj, Value, w_nil, w_true, w_false, wrap_bool
 from lox.object import ObjString, Obj, ObjFunction
+from lox.table import GlobalTable, StringTable
+from lox.optimizer import make_pass_manager
+from lox import profiler, sampler
 
 from rpython.rlib import jit
+from rpython.rlib.debug import make_sure_not_resized
 from rpython.rlib.jit import JitDriver, we_are_translated, we_are_jitted, promote
 
 
+# Rewrite generic arithmetic and comparison instructions to type-specialized
+# variants after their first execution. See VM._quicken.
+ENABLE_QUICKENING = True
+
 jitdriver = JitDriver(greens=['ip', 'chunk',],
-                      reds=['stack_top', 'stack', 'frame', 'self'],
+                      reds=['frame', 'self'],
+                      virtualizables=['frame'],
                       get_printable_location=get_printable_location)
 
 
 def jitpolicy(driver):
     from rpython.jit.codewriter.policy import JitPolicy
-    return JitPolicy()
+    from lox.jit_stats import hooks
+    return JitPolicy(hooks)
 
 
 class InterpretResult:
@@ -33,334 +43,724 @@ class InterpretRuntimeError(RuntimeError):
 
 
 class CallFrame(object):
-    def __init__(self, function, ip, slots):
+    """One function activation: its instruction pointer and value stack.
+
+    Frames are virtualizable, so in a trace the stack slots and stack_top
+    live in registers and are only written back when the frame escapes.
+    Slot 0 holds the callee, followed by its arguments, its locals and the
+    temporaries of the expression being evaluated.
+    """
+    _virtualizable_ = ['ip', 'stack_top', 'stack[*]']
+    _immutable_fields_ = ['function', 'caller', 'depth']
+
+    def __init__(self, function, caller):
+        self = jit.hint(self, access_directly=True, fresh_virtualizable=True)
         self.function = function
-        self.ip = ip
-        self.slots = slots
-
-    # def pop_slot(self):
-    #     slot_top = jit.promote(self.slot_top)
-    #     w_x = self.slots[slot_top]
-    #     slot_top -= 1
-    #     self.slots[slot_top] = None
-    #     self.slot_top = slot_top
-    #     return w_x
-
-    # def push_slot(self, w_x):
-    #     slot_top = jit.promote(self.stlot_top)
-    #     self.slots[slot_top] = w_x
-    #     self.stack_top = stack_top + 1
-
-
-class VM(object):
-    _immutable_fields_ = ['chunk', 'STACK_MAX_SIZE', 'FRAMES_MAX']
-
-    global_objects = {}
-    STACK_MAX_SIZE = 16
-    FRAMES_MAX = 64
-
-    def __init__(self, debug=True):
-        self.debug_trace = debug
-        self._reset_stack()
-
-        self.FRAMES_MAX = 64
-        self.frames = [None] * self.FRAMES_MAX
-
-        self.chunk = None
-        self.stack = [None] * self.STACK_MAX_SIZE
-        self.stack_top = 0
-
-        self.frames = [None] * self.FRAMES_MAX
-        self.frame_ptr = 0
-        self.frame = None
-
-        # self.ip = 0 # Moved to CallFrame
-
-    def _reset_stack(self):
-        self.stack = [None] * self.STACK_MAX_SIZE
+        self.caller = caller
+        if caller is None:
+            self.depth = 0
+        else:
+            self.depth = caller.depth + 1
+        self.ip = 0
+        self.stack = [None] * (function.arity + 1 + function.chunk.max_stack)
+        make_sure_not_resized(self.stack)
         self.stack_top = 0
 
-    def _reset_global_objects(self):
-        self.global_objects = {}
-
-    def _reset(self):
-        self._reset_stack()
-        self._reset_global_objects()
-
-    def _push_stack(self, value):
+    def push(self, value):
         stack_top = jit.promote(self.stack_top)
+        assert stack_top >= 0
+        # The stack is sized by optimizer.max_stack_depth. The length is a
+        # constant to the JIT, so the check folds away in traces.
+        assert stack_top < len(self.stack)
         self.stack[stack_top] = value
         self.stack_top = stack_top + 1
 
-    def _pop_stack(self):
+    def pop(self):
         stack_top = jit.promote(self.stack_top)
         stack_top -= 1
         assert stack_top >= 0
         self.stack_top = stack_top
         return self.stack[stack_top]
 
-    def _peek_stack(self, n):
-        stack_top = jit.promote(self.stack_top)
-        assert n < stack_top
-        return self.stack[stack_top - (n + 1)]
+    def peek(self, n):
+        index = jit.promote(self.stack_top) - (n + 1)
+        assert index >= 0
+        return self.stack[index]
 
-    def _take_stack(self, n):
-        assert n < self.stack_top
-        assert 0 <= n
-        return self.stack[n]
+    def replace_operands(self, w_result):
+        # Pop two operands and push the result
+        index = jit.promote(self.stack_top) - 2
+        assert index >= 0
+        self.stack[index] = w_result
+        self.stack_top = index + 1
 
-    def _trace_stack(self):
+    def get_local(self, slot):
+        assert 0 <= slot and slot < self.stack_top
+        return self.stack[slot]
+
+    def set_local(self, slot, value):
+        assert 0 <= slot and slot < self.stack_top
+        self.stack[slot] = value
+
+
+class VM(object):
+    _immutable_fields_ = ['chunk', 'FRAMES_MAX']
+
+    FRAMES_MAX = 64
+    # Short concatenation results are the ones that end up as keys and in
+    # comparisons; long ones are rarely seen twice and would only grow the
+    # intern table.
+    INTERN_CONCAT_MAX_LENGTH = 64
+
+    def __init__(self, debug=True, opt_level=1):
+        self.debug_trace = debug
+        self.chunk = None
+        self.opt_level = opt_level
+        self.pass_manager = make_pass_manager(opt_level, debug_print=debug)
+        self.global_table = GlobalTable()
+        self.string_table = StringTable()
+        # An InstructionProfile while running with --profile
+        self.profile = None
+        # A CallProfile while running with --profile-calls
+        self.call_profile = None
+
+    def _trace_stack(self, frame):
         print "       ",
-        if self.stack_top == 0:
+        if frame.stack_top == 0:
             print "[]"
             return
 
         print "[",
-        for i in range(self.stack_top):
-            w_x = self.stack[i]
+        for i in range(frame.stack_top):
+            w_x = frame.stack[i]
             if w_x: print w_x.repr(),
             else: print "None",
         print "]"
 
-        # print "       ",
-        # print self.global_objects
-
-    def _runtime_error(self, message):
-        line_number = format_line_number(self.frame.function.chunk, self.frame.ip)
-        print "%s\n[line %s] in script" % (message, line_number)
-        self._reset()
+    def _runtime_error(self, frame, message):
+        print message
+        while frame is not None:
+            line = frame.function.chunk.get_line(frame.ip - 1)
+            if frame.function.name == "<script>":
+                print "[line %d] in script" % line
+            else:
+                print "[line %d] in %s()" % (line, frame.function.name)
+            frame = frame.caller
 
     # def interpret_chunk(self, chunk):
     #     self.chunk = chunk
     #     self.ip = 0
     #     return self.run()
 
-    def _read_byte(self):
-        chunk = self.frame.function.chunk
-        jit.promote(chunk)
-        instruction = chunk.code[self.frame.ip]
-        self.frame.ip += 1
+    # The instruction pointer is promoted along with the chunk: a trace
+    # entered at a function's start or through a bridge then reads its
+    # instructions and operands as constants instead of from the array.
+
+    def _read_opcode(self, frame):
+        chunk = jit.promote(frame.function.chunk)
+        ip = jit.promote(frame.ip)
+        if ENABLE_QUICKENING and not we_are_jitted():
+            instruction = ord(chunk.quickened[ip])
+        else:
+            instruction = ord(chunk.code[ip])
+        frame.ip = ip + 1
+        return instruction
+
+    def _read_byte(self, frame):
+        chunk = jit.promote(frame.function.chunk)
+        ip = jit.promote(frame.ip)
+        instruction = ord(chunk.code[ip])
+        frame.ip = ip + 1
         return instruction
 
-    def _read_short(self):
-        chunk = self.frame.function.chunk
-        jit.promote(chunk)
-        offset1 = chunk.code[self.frame.ip]
-        offset2 = chunk.code[self.frame.ip + 1]
-        self.frame.ip += 2
+    def _read_short(self, frame):
+        chunk = jit.promote(frame.function.chunk)
+        ip = jit.promote(frame.ip)
+        offset1 = ord(chunk.code[ip])
+        offset2 = ord(chunk.code[ip + 1])
+        frame.ip = ip + 2
         return offset1 << 8 | offset2
 
-    def _read_constant(self):
-        constant_index = self._read_byte()
-        return self.frame.function.chunk.constants[constant_index]
+    def _read_constant(self, frame):
+        constant_index = self._read_byte(frame)
+        return frame.function.chunk.constants[constant_index]
 
-    def _read_string(self):
-        w_const = self._read_constant()
+    def _read_string(self, frame):
+        w_const = self._read_constant(frame)
         assert isinstance(w_const, ValueObj)
         obj_str = w_const.get_value()
         isinstance(obj_str, ObjString)
         return obj_str
 
     def interpret(self, source):
-        self._reset()
-
-        compiler = Compiler(source, debug_print=self.debug_trace)
-        function = compiler.compile()
+        function = self.compile(source)
         if function:
-            self._push_stack(ValueObj(function))
-            self.frame = CallFrame(function=function, ip=0, slots=self.stack[:])
-            self.frames[self.frame_ptr] = self.frame
-            self.frame_ptr += 1
-            return self.run()
+            return self.interpret_function(function)
         else:
             return InterpretResult.INTERPRET_COMPILE_ERROR
 
-    def run(self):
+    def compile(self, source):
+        """Compile and optimize `source`. Returns the script function, or
+        None after a compile error."""
+        compiler = Compiler(source, debug_print=self.debug_trace,
+                            global_table=self.global_table,
+                            string_table=self.string_table)
+        function = compiler.compile()
+        if function and self.pass_manager is not None:
+            self.pass_manager.run(function)
+        return function
+
+    def interpret_function(self, function):
+        function.chunk.freeze(quickening=ENABLE_QUICKENING)
+        frame = CallFrame(function, None)
+        frame.push(ValueObj(function))
+        if profiler.PROFILING_ENABLED and self.call_profile is not None:
+            self.call_profile.enter(function, 0)
+            self.run(frame)
+            self.call_profile.leave()
+        else:
+            self.run(frame)
+        return InterpretResult.INTERPRET_OK
+
+    def run(self, frame):
+        """Run `frame` until it returns, and return its result. Calls run
+        their own frame through a nested run().
+
+        Entering run() counts toward the JIT's function_threshold, so a
+        function that is called often is traced from its first instruction
+        even if it has no loop. Traces inline the calls they meet, and a
+        call to a function that already has a compiled entry, recursive
+        ones included, becomes a direct call to that machine code.
+        """
         instruction = None
-        self.frame_ptr -= 1
-        self.frame = self.frames[self.frame_ptr]
-        if we_are_jitted():
-            self.frames[self.frame_ptr + 1] = None
         while True:
             if not we_are_translated():
                 if self.debug_trace:
-                    disassemble_instruction(self.frame.function.chunk, self.frame.ip)
-                    self._trace_stack()
-
-            jitdriver.jit_merge_point(ip=self.frame.ip, chunk=self.frame.function.chunk,
-                                      stack=self.stack, stack_top=self.stack_top,
-                                      frame=self.frame, self=self)
-            promote(self.stack_top)
-            instruction = self._read_byte()
+                    disassemble_instruction(frame.function.chunk, frame.ip)
+                    self._trace_stack(frame)
+
+            jitdriver.jit_merge_point(ip=frame.ip, chunk=frame.function.chunk,
+                                      frame=frame, self=self)
+            instruction = self._read_opcode(frame)
+            if profiler.PROFILING_ENABLED and self.profile is not None:
+                self.profile.count(frame.function, frame.ip - 1, instruction)
             if instruction == OpCode.OP_RETURN:
-                return InterpretResult.INTERPRET_OK
+                return frame.pop()
             elif instruction == OpCode.OP_NOP:
                 pass
             elif instruction == OpCode.OP_CONSTANT:
-                self._constant()
+                self._constant(frame)
+            elif instruction == OpCode.OP_CONSTANT_LONG:
+                self._constant_long(frame)
             elif instruction == OpCode.OP_NIL:
-                self._push_stack(ValueNil())
+                frame.push(w_nil)
             elif instruction == OpCode.OP_TRUE:
-                self._push_stack(ValueBool(True))
+                frame.push(w_true)
             elif instruction == OpCode.OP_FALSE:
-                self._push_stack(ValueBool(False))
+                frame.push(w_false)
             elif instruction == OpCode.OP_NOT:
-                self._unary_op("!")
+                self._not(frame)
+            elif instruction == OpCode.OP_NEGATE:
+                self._negate(frame)
             elif instruction == OpCode.OP_EQUAL:
-                self._binary_op("==")
+                self._binary_op(frame, OpCode.OP_EQUAL)
+            elif instruction == OpCode.OP_NOT_EQUAL:
+                self._binary_op(frame, OpCode.OP_NOT_EQUAL)
+            elif instruction == OpCode.OP_LESS_EQUAL:
+                self._binary_op(frame, OpCode.OP_LESS_EQUAL)
+            elif instruction == OpCode.OP_GREATER_EQUAL:
+                self._binary_op(frame, OpCode.OP_GREATER_EQUAL)
             elif instruction == OpCode.OP_LESS:
-                self._binary_op("<")
+                self._binary_op(frame, OpCode.OP_LESS)
             elif instruction == OpCode.OP_GREATER:
-                self._binary_op(">")
-            elif instruction == OpCode.OP_NEGATE:
-                self._push_stack(self._pop_stack().negate())
+                self._binary_op(frame, OpCode.OP_GREATER)
             elif instruction == OpCode.OP_ADD:
-                self._binary_op("+")
+                self._binary_op(frame, OpCode.OP_ADD)
             elif instruction == OpCode.OP_SUBTRACT:
-                self._binary_op("-")
+                self._binary_op(frame, OpCode.OP_SUBTRACT)
             elif instruction == OpCode.OP_MULTIPLY:
-                self._binary_op("*")
+                self._binary_op(frame, OpCode.OP_MULTIPLY)
             elif instruction == OpCode.OP_DIVIDE:
-                self._binary_op("/")
-            elif instruction == OpCode.OP_NEGATE:
-                self._unary_op("-")
+                self._binary_op(frame, OpCode.OP_DIVIDE)
+            elif instruction == OpCode.OP_ADD_NUM:
+                self._add_num(frame)
+            elif instruction == OpCode.OP_ADD_STR:
+                self._add_str(frame)
+            elif instruction == OpCode.OP_SUBTRACT_NUM:
+                self._subtract_num(frame)
+            elif instruction == OpCode.OP_MULTIPLY_NUM:
+                self._multiply_num(frame)
+            elif instruction == OpCode.OP_DIVIDE_NUM:
+                self._divide_num(frame)
+            elif instruction == OpCode.OP_LESS_NUM:
+                self._less_num(frame)
+            elif instruction == OpCode.OP_GREATER_NUM:
+                self._greater_num(frame)
+            elif instruction == OpCode.OP_LESS_EQUAL_NUM:
+                self._less_equal_num(frame)
+            elif instruction == OpCode.OP_GREATER_EQUAL_NUM:
+                self._greater_equal_num(frame)
             elif instruction == OpCode.OP_PRINT:
-                self._print()
+                self._print(frame)
             elif instruction == OpCode.OP_POP:
-                self._pop_stack()
-            elif instruction == OpCode.OP_DEFINE_GLOBAL:
-                self._define_global()
-            elif instruction == OpCode.OP_GET_GLOBAL:
-                self._get_global()
-            elif instruction == OpCode.OP_SET_GLOBAL:
-                self._set_global()
+                frame.pop()
+            elif instruction == OpCode.OP_DEFINE_GLOBAL_SLOT:
+                self._define_global(frame, self._read_byte(frame))
+            elif instruction == OpCode.OP_GET_GLOBAL_SLOT:
+                self._get_global(frame, self._read_byte(frame))
+            elif instruction == OpCode.OP_SET_GLOBAL_SLOT:
+                self._set_global(frame, self._read_byte(frame))
             elif instruction == OpCode.OP_GET_LOCAL:
-                self._get_local()
+                self._get_local(frame, self._read_byte(frame))
             elif instruction == OpCode.OP_SET_LOCAL:
-                self._set_local()
+                self._set_local(frame, self._read_byte(frame))
+            elif instruction == OpCode.OP_GET_LOCAL_GET_LOCAL:
+                self._get_local_get_local(frame)
+            elif instruction == OpCode.OP_ADD_LOCAL_CONST:
+                self._add_local_const(frame)
+            elif instruction == OpCode.OP_INCR_LOCAL:
+                self._incr_local(frame)
             elif instruction == OpCode.OP_JUMP_IF_FALSE:
-                offset = self._read_short()
-                if self._peek_stack(0).is_falsy():
-                    self.frame.ip += offset
+                offset = self._read_short(frame)
+                if frame.peek(0).is_falsy():
+                    frame.ip += offset
+            elif instruction == OpCode.OP_POP_JUMP_IF_FALSE:
+                offset = self._read_short(frame)
+                if frame.pop().is_falsy():
+                    frame.ip += offset
+            elif instruction == OpCode.OP_JUMP_IF_NOT_EQUAL:
+                self._compare_and_jump(frame, OpCode.OP_EQUAL)
+            elif instruction == OpCode.OP_JUMP_IF_EQUAL:
+                self._compare_and_jump(frame, OpCode.OP_NOT_EQUAL)
+            elif instruction == OpCode.OP_JUMP_IF_NOT_LESS:
+                self._compare_and_jump(frame, OpCode.OP_LESS)
+            elif instruction == OpCode.OP_JUMP_IF_NOT_LESS_EQUAL:
+                self._compare_and_jump(frame, OpCode.OP_LESS_EQUAL)
+            elif instruction == OpCode.OP_JUMP_IF_NOT_GREATER:
+                self._compare_and_jump(frame, OpCode.OP_GREATER)
+            elif instruction == OpCode.OP_JUMP_IF_NOT_GREATER_EQUAL:
+                self._compare_and_jump(frame, OpCode.OP_GREATER_EQUAL)
             elif instruction == OpCode.OP_JUMP:
-                offset = self._read_short()
-                self.frame.ip += offset
+                offset = self._read_short(frame)
+                frame.ip += offset
             elif instruction == OpCode.OP_LOOP: # backward jump
-                offset = self._read_short()
-                self.frame.ip -= offset
-                jitdriver.can_enter_jit(ip=self.frame.ip, chunk=self.frame.function.chunk,
-                                        stack=self.stack, stack_top=self.stack_top,
-                                        frame=self.frame, self=self)
+                offset = self._read_short(frame)
+                frame.ip -= offset
+                self._sample_tick(frame)
+                jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                        frame=frame, self=self)
+            elif instruction == OpCode.OP_POP_LOOP_IF_TRUE:
+                offset = self._read_short(frame)
+                if not frame.pop().is_falsy():
+                    frame.ip -= offset
+                    self._sample_tick(frame)
+                    jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                            frame=frame, self=self)
+            elif instruction == OpCode.OP_LOOP_IF_EQUAL:
+                if self._compare_and_loop(frame, OpCode.OP_EQUAL):
+                    self._sample_tick(frame)
+                    jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                            frame=frame, self=self)
+            elif instruction == OpCode.OP_LOOP_IF_NOT_EQUAL:
+                if self._compare_and_loop(frame, OpCode.OP_NOT_EQUAL):
+                    self._sample_tick(frame)
+                    jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                            frame=frame, self=self)
+            elif instruction == OpCode.OP_LOOP_IF_LESS:
+                if self._compare_and_loop(frame, OpCode.OP_LESS):
+                    self._sample_tick(frame)
+                    jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                            frame=frame, self=self)
+            elif instruction == OpCode.OP_LOOP_IF_LESS_EQUAL:
+                if self._compare_and_loop(frame, OpCode.OP_LESS_EQUAL):
+                    self._sample_tick(frame)
+                    jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                            frame=frame, self=self)
+            elif instruction == OpCode.OP_LOOP_IF_GREATER:
+                if self._compare_and_loop(frame, OpCode.OP_GREATER):
+                    self._sample_tick(frame)
+                    jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                            frame=frame, self=self)
+            elif instruction == OpCode.OP_LOOP_IF_GREATER_EQUAL:
+                if self._compare_and_loop(frame, OpCode.OP_GREATER_EQUAL):
+                    self._sample_tick(frame)
+                    jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                            frame=frame, self=self)
+            elif instruction == OpCode.OP_WIDE:
+                if self._wide(frame):
+                    self._sample_tick(frame)
+                    jitdriver.can_enter_jit(ip=frame.ip, chunk=frame.function.chunk,
+                                            frame=frame, self=self)
             elif instruction == OpCode.OP_CALL:
-                arg_count = self._read_byte()
-                if not self._call_value(self._peek_stack(arg_count), arg_count):
+                arg_count = self._read_byte(frame)
+                if not self._call_value(frame, frame.peek(arg_count), arg_count):
                     raise InterpretRuntimeError
             else:
                 print "Unknown opcode"
                 raise InterpretRuntimeError()
 
-    def _unary_op(self, op):
-        if op == "-":
-            if not self._peek_stack(0).is_number():
-                self._runtime_error("Runtime error")
-                raise InterpretRuntimeError()
-            self._push_stack(self._pop_stack().negate())
-        elif op == "!":
-            self._push_stack(ValueBool(self._pop_stack().is_falsy()))
-
-    def _binary_op(self, op):
-        w_y = self._pop_stack()
-        w_x = self._pop_stack()
-        if op == "+":
-            if w_x.is_string() and w_y.is_string():
-                self._concatinate(w_x, w_y)
-            elif w_x.is_number() and w_y.is_number():
-                self._push_stack(w_x.add(w_y))
+    def _not(self, frame):
+        frame.push(wrap_bool(frame.pop().is_falsy()))
+
+    def _negate(self, frame):
+        if not frame.peek(0).is_number():
+            self._runtime_error(frame, "Operand must be a number.")
+            raise InterpretRuntimeError()
+        frame.push(frame.pop().negate())
+
+    def _quicken(self, frame, opcode):
+        """Rewrite the instruction being executed to `opcode`.
+
+        Traces never rewrite code: the JIT already specializes on the
+        operand types it sees.
+        """
+        if ENABLE_QUICKENING and not we_are_jitted():
+            frame.function.chunk.quicken(frame.ip - 1, opcode)
+
+    def _binary_op(self, frame, op):
+        # Generic path: handles any operand types, then quickens the
+        # instruction to the variant for the types just seen.
+        w_y = frame.pop()
+        w_x = frame.pop()
+        if op == OpCode.OP_EQUAL:
+            frame.push(wrap_bool(w_x.is_equal(w_y)))
+            return
+        if op == OpCode.OP_NOT_EQUAL:
+            frame.push(wrap_bool(not w_x.is_equal(w_y)))
+            return
+
+        if op == OpCode.OP_ADD and w_x.is_string() and w_y.is_string():
+            self._quicken(frame, OpCode.OP_ADD_STR)
+            frame.push(self._concatinate(w_x, w_y))
+            return
+
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            if op == OpCode.OP_ADD:
+                self._runtime_error(frame, "Operands must be two numbers or two strings.")
             else:
-                self._runtime_error("Operands must be two numbers or two strings.")
-                raise InterpretRuntimeError()
-        elif op == "-":
-            self._push_stack(w_x.sub(w_y))
-        elif op == "*":
-            self._push_stack(w_x.mul(w_y))
-        elif op == "/":
-            self._push_stack(w_x.div(w_y))
-        elif op == "<":
-            w_z = ValueBool(w_x.as_number() < w_y.as_number())
-            self._push_stack(w_z)
-        elif op == ">":
-            w_z = ValueBool(w_x.as_number() > w_y.as_number())
-            self._push_stack(w_z)
-        elif op == "==":
-            w_z = ValueBool(w_x.as_number() == w_y.as_number())
-            self._push_stack(w_z)
+                self._runtime_error(frame, "Operands must be numbers.")
+            raise InterpretRuntimeError()
+
+        if op == OpCode.OP_ADD:
+            self._quicken(frame, OpCode.OP_ADD_NUM)
+            frame.push(w_x.add(w_y))
+        elif op == OpCode.OP_SUBTRACT:
+            self._quicken(frame, OpCode.OP_SUBTRACT_NUM)
+            frame.push(w_x.sub(w_y))
+        elif op == OpCode.OP_MULTIPLY:
+            self._quicken(frame, OpCode.OP_MULTIPLY_NUM)
+            frame.push(w_x.mul(w_y))
+        elif op == OpCode.OP_DIVIDE:
+            self._quicken(frame, OpCode.OP_DIVIDE_NUM)
+            frame.push(w_x.div(w_y))
+        elif op == OpCode.OP_LESS:
+            self._quicken(frame, OpCode.OP_LESS_NUM)
+            frame.push(wrap_bool(w_x.value < w_y.value))
+        elif op == OpCode.OP_GREATER:
+            self._quicken(frame, OpCode.OP_GREATER_NUM)
+            frame.push(wrap_bool(w_x.value > w_y.value))
+        elif op == OpCode.OP_LESS_EQUAL:
+            self._quicken(frame, OpCode.OP_LESS_EQUAL_NUM)
+            frame.push(wrap_bool(w_x.value <= w_y.value))
+        elif op == OpCode.OP_GREATER_EQUAL:
+            self._quicken(frame, OpCode.OP_GREATER_EQUAL_NUM)
+            frame.push(wrap_bool(w_x.value >= w_y.value))
+
+    def _unquicken(self, frame, op):
+        # The operands no longer match the specialized instruction
+        self._quicken(frame, op)
+        self._binary_op(frame, op)
+
+    def _add_num(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            return self._unquicken(frame, OpCode.OP_ADD)
+        frame.replace_operands(w_x.add(w_y))
+
+    def _add_str(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (w_x.is_string() and w_y.is_string()):
+            return self._unquicken(frame, OpCode.OP_ADD)
+        frame.replace_operands(self._concatinate(w_x, w_y))
+
+    def _subtract_num(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            return self._unquicken(frame, OpCode.OP_SUBTRACT)
+        frame.replace_operands(w_x.sub(w_y))
+
+    def _multiply_num(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            return self._unquicken(frame, OpCode.OP_MULTIPLY)
+        frame.replace_operands(w_x.mul(w_y))
+
+    def _divide_num(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            return self._unquicken(frame, OpCode.OP_DIVIDE)
+        frame.replace_operands(w_x.div(w_y))
+
+    def _less_num(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            return self._unquicken(frame, OpCode.OP_LESS)
+        frame.replace_operands(wrap_bool(w_x.value < w_y.value))
+
+    def _greater_num(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            return self._unquicken(frame, OpCode.OP_GREATER)
+        frame.replace_operands(wrap_bool(w_x.value > w_y.value))
+
+    def _less_equal_num(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            return self._unquicken(frame, OpCode.OP_LESS_EQUAL)
+        frame.replace_operands(wrap_bool(w_x.value <= w_y.value))
+
+    def _greater_equal_num(self, frame):
+        w_y = frame.peek(0)
+        w_x = frame.peek(1)
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            return self._unquicken(frame, OpCode.OP_GREATER_EQUAL)
+        frame.replace_operands(wrap_bool(w_x.value >= w_y.value))
+
+    def _compare(self, frame, op):
+        # Pop two operands and compare them without allocating a ValueBool
+        w_y = frame.pop()
+        w_x = frame.pop()
+        if op == OpCode.OP_EQUAL:
+            return w_x.is_equal(w_y)
+        if op == OpCode.OP_NOT_EQUAL:
+            return not w_x.is_equal(w_y)
+
+        if not (isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber)):
+            self._runtime_error(frame, "Operands must be numbers.")
+            raise InterpretRuntimeError()
+        if op == OpCode.OP_LESS:
+            return w_x.value < w_y.value
+        elif op == OpCode.OP_LESS_EQUAL:
+            return w_x.value <= w_y.value
+        elif op == OpCode.OP_GREATER:
+            return w_x.value > w_y.value
+        else:
+            return w_x.value >= w_y.value
+
+    def _compare_and_jump(self, frame, op):
+        offset = self._read_short(frame)
+        if not self._compare(frame, op):
+            frame.ip += offset
+
+    def _compare_and_loop(self, frame, op):
+        offset = self._read_short(frame)
+        if self._compare(frame, op):
+            frame.ip -= offset
+            return True
+        return False
 
     def _concatinate(self, w_x, w_y):
         assert isinstance(w_x, ValueObj)
         assert isinstance(w_y, ValueObj)
         obj_str1 = w_x.get_value()
         obj_str2 = w_y.get_value()
-        w_z = ValueObj(obj_str1.concat(obj_str2))
-        self._push_stack(w_z)
-
-    def _call_value(self, callee, arg_count):
+        assert isinstance(obj_str1, ObjString)
+        assert isinstance(obj_str2, ObjString)
+        if obj_str1.length + obj_str2.length <= self.INTERN_CONCAT_MAX_LENGTH:
+            obj_str = self.string_table.intern(obj_str1.buffer + obj_str2.buffer)
+        else:
+            obj_str = obj_str1.concat(obj_str2)
+        return ValueObj(obj_str)
+
+    def _add_values(self, frame, w_x, w_y):
+        if isinstance(w_x, ValueNumber) and isinstance(w_y, ValueNumber):
+            return w_x.add(w_y)
+        elif w_x.is_string() and w_y.is_string():
+            return self._concatinate(w_x, w_y)
+        self._runtime_error(frame, "Operands must be two numbers or two strings.")
+        raise InterpretRuntimeError()
+
+    def _call_value(self, frame, callee, arg_count):
         if isinstance(callee, ValueObj):
             objfun = callee.get_value()
             if isinstance(objfun, ObjFunction):
-                return self._call(objfun, arg_count)
+                return self._call(frame, objfun, arg_count)
             else:
-                self._runtime_error("Can only call functions and classes.")
+                self._runtime_error(frame, "Can only call functions and classes.")
         return False
 
-    def _call(self, function, arg_count):
-        i = self.stack_top - (arg_count + 1)
-        assert not i < 0
-        new_frame = CallFrame(function, ip=0,
-                              slots=self.stack[i:][:])
-        self.frame = new_frame
-        self.stack = new_frame.slots[:]
-        self.stack_top = arg_count + 1
+    def _call(self, frame, function, arg_count):
+        # A call site nearly always calls the same function. With the callee
+        # constant, the arity check and frame size fold away, and the JIT
+        # can inline its body or, for recursion, call its compiled entry.
+        function = jit.promote(function)
+        if arg_count != function.arity:
+            self._runtime_error(frame, "Expected %d arguments but got %d." % (function.arity, arg_count))
+            return False
+        if frame.depth + 1 >= self.FRAMES_MAX:
+            self._runtime_error(frame, "Stack overflow.")
+            return False
+
+        callee = CallFrame(function, frame)
+        self._move_arguments(frame, callee, arg_count)
+        self._sample_tick(callee)
+        if profiler.PROFILING_ENABLED and self.call_profile is not None:
+            self.call_profile.enter(function, frame.ip)
+            w_result = self.run(callee)
+            self.call_profile.leave()
+            frame.push(w_result)
+        else:
+            frame.push(self.run(callee))
         return True
 
-    def _set_local(self):
-        slot = self._read_byte()
-        self.stack[slot] = self._peek_stack(0)
-
-    def _set_global(self):
-        name = self._read_string()
-        assert isinstance(name, ObjString)
-        name_hash = name.hash()
-        if not name_hash in self.global_objects:
-            self._runtime_error("Undefined variable '%s'." % name)
+    def _sample_tick(self, frame):
+        # Calls and loop back-edges; see lox/sampler.py
+        active = sampler.state.sampler
+        if active is not None:
+            active.tick(frame)
+
+    @jit.unroll_safe
+    def _move_arguments(self, frame, callee, arg_count):
+        # Move the function and its arguments over to the callee's slots
+        base = jit.promote(frame.stack_top) - (arg_count + 1)
+        assert base >= 0
+        for i in range(arg_count + 1):
+            callee.push(frame.stack[base + i])
+        frame.stack_top = base
+
+    def _set_local(self, frame, slot):
+        frame.set_local(slot, frame.peek(0))
+
+    def _global_cell(self, slot):
+        global_table = jit.promote(self.global_table)
+        return global_table.get_cell(slot)
+
+    def _set_global(self, frame, slot):
+        cell = self._global_cell(slot)
+        if not cell.is_defined():
+            self._runtime_error(frame, "Undefined variable '%s'." % cell.name)
             raise InterpretRuntimeError()
-        self.global_objects[name_hash] = self._pop_stack()
-        self._push_stack(ValueNil()) # To handle with OP_POP
-
-    def _get_local(self):
-        slot = self._read_byte()
-        self._push_stack(self._take_stack(slot + 1))
-
-    def _get_global(self):
-        name = self._read_string()
-        assert isinstance(name, ObjString)
-        name_hash = name.hash()
-        if name_hash not in self.global_objects:
-            self._runtime_error("Undefined variable '%s'." % name)
+        cell.set(frame.peek(0))
+
+    def _get_local(self, frame, slot):
+        frame.push(frame.get_local(slot))
+
+    def _get_local_get_local(self, frame):
+        slot1 = self._read_byte(frame)
+        slot2 = self._read_byte(frame)
+        frame.push(frame.get_local(slot1))
+        frame.push(frame.get_local(slot2))
+
+    def _add_local_const(self, frame):
+        w_x = frame.get_local(self._read_byte(frame))
+        w_y = self._read_constant(frame)
+        frame.push(self._add_values(frame, w_x, w_y))
+
+    def _incr_local(self, frame):
+        slot = self._read_byte(frame)
+        w_y = self._read_constant(frame)
+        frame.set_local(slot, self._add_values(frame, frame.get_local(slot), w_y))
+
+    def _get_global(self, frame, slot):
+        cell = self._global_cell(slot)
+        w_value = cell.get()
+        if w_value is None:
+            self._runtime_error(frame, "Undefined variable '%s'." % cell.name)
             raise InterpretRuntimeError()
-        self._push_stack(self.global_objects[name_hash])
-
-    def _define_global(self):
-        name = self._read_string()
-        assert isinstance(name, ObjString)
-        name_hash = name.hash()
-        self.global_objects[name_hash] = self._pop_stack()
+        frame.push(w_value)
+
+    def _define_global(self, frame, slot):
+        cell = self._global_cell(slot)
+        cell.set(frame.pop())
+
+    def _constant(self, frame):
+        w_const = self._read_constant(frame)
+        frame.push(w_const)
+
+    def _constant_long(self, frame):
+        index = self._read_byte(frame) << 16
+        index |= self._read_short(frame)
+        frame.push(frame.function.chunk.constants[index])
+
+    def _wide(self, frame):
+        """Run the instruction behind an OP_WIDE prefix. Returns True if it
+        was a backward jump that was taken."""
+        instruction = self._read_byte(frame)
+        if instruction in OpCode.JumpOps:
+            offset = self._read_short(frame) << 16
+            offset |= self._read_short(frame)
+            return self._wide_jump(frame, instruction, offset)
+
+        slot = self._read_short(frame)
+        if instruction == OpCode.OP_GET_LOCAL:
+            self._get_local(frame, slot)
+        elif instruction == OpCode.OP_SET_LOCAL:
+            self._set_local(frame, slot)
+        elif instruction == OpCode.OP_GET_GLOBAL_SLOT:
+            self._get_global(frame, slot)
+        elif instruction == OpCode.OP_SET_GLOBAL_SLOT:
+            self._set_global(frame, slot)
+        elif instruction == OpCode.OP_DEFINE_GLOBAL_SLOT:
+            self._define_global(frame, slot)
+        else:
+            print "Unknown opcode"
+            raise InterpretRuntimeError()
+        return False
 
-    def _constant(self):
-        w_const = self._read_constant()
-        self._push_stack(w_const)
+    def _wide_jump(self, frame, instruction, offset):
+        if instruction == OpCode.OP_JUMP:
+            taken = True
+        elif instruction == OpCode.OP_JUMP_IF_FALSE:
+            taken = frame.peek(0).is_falsy()
+        elif instruction == OpCode.OP_POP_JUMP_IF_FALSE:
+            taken = frame.pop().is_falsy()
+        elif instruction == OpCode.OP_JUMP_IF_NOT_EQUAL:
+            taken = not self._compare(frame, OpCode.OP_EQUAL)
+        elif instruction == OpCode.OP_JUMP_IF_EQUAL:
+            taken = not self._compare(frame, OpCode.OP_NOT_EQUAL)
+        elif instruction == OpCode.OP_JUMP_IF_NOT_LESS:
+            taken = not self._compare(frame, OpCode.OP_LESS)
+        elif instruction == OpCode.OP_JUMP_IF_NOT_LESS_EQUAL:
+            taken = not self._compare(frame, OpCode.OP_LESS_EQUAL)
+        elif instruction == OpCode.OP_JUMP_IF_NOT_GREATER:
+            taken = not self._compare(frame, OpCode.OP_GREATER)
+        elif instruction == OpCode.OP_JUMP_IF_NOT_GREATER_EQUAL:
+            taken = not self._compare(frame, OpCode.OP_GREATER_EQUAL)
+        elif instruction == OpCode.OP_LOOP:
+            taken = True
+        elif instruction == OpCode.OP_POP_LOOP_IF_TRUE:
+            taken = not frame.pop().is_falsy()
+        elif instruction == OpCode.OP_LOOP_IF_EQUAL:
+            taken = self._compare(frame, OpCode.OP_EQUAL)
+        elif instruction == OpCode.OP_LOOP_IF_NOT_EQUAL:
+            taken = self._compare(frame, OpCode.OP_NOT_EQUAL)
+        elif instruction == OpCode.OP_LOOP_IF_LESS:
+            taken = self._compare(frame, OpCode.OP_LESS)
+        elif instruction == OpCode.OP_LOOP_IF_LESS_EQUAL:
+            taken = self._compare(frame, OpCode.OP_LESS_EQUAL)
+        elif instruction == OpCode.OP_LOOP_IF_GREATER:
+            taken = self._compare(frame, OpCode.OP_GREATER)
+        else:
+            taken = self._compare(frame, OpCode.OP_GREATER_EQUAL)
+
+        if not taken:
+            return False
+        if instruction in OpCode.BackwardJumpOps:
+            frame.ip -= offset
+            return True
+        frame.ip += offset
+        return False
 
-    def _print(self):
-        value = self._pop_stack()
+    def _print(self, frame):
+        value = frame.pop()
         if isinstance(value, Value) or isinstance(value, Obj):
             print value.repr()
         else:
@@ -1,24 +1,37 @@
 import os
 import sys
 
+from lox import jit_stats, profiler
 from lox.main import main
+from lox.vm import jitpolicy
 
 
 def entry_point(argv):
     return main(argv)
 
 
-def target(driver, _args):
+def target(driver, args):
     exe_name = "rlox"
 
     if driver.config.translation.jit:
         exe_name += "-jit"
+        jit_stats.JIT_ENABLED = True
     else:
         exe_name += "-interp"
 
+    # --profiling builds support --profile; the others leave the counting
+    # out of the interpreter loop altogether
+    profiler.PROFILING_ENABLED = "--profiling" in args
+    if profiler.PROFILING_ENABLED:
+        exe_name += "-profiling"
+
     driver.exe_name = exe_name
     return entry_point, None
 
 
+# Lets target() see its own arguments, e.g. rpython -O2 targetlox.py --profiling
+take_options = True
+
+
 if __name__ == "__main__":
     entry_point(sys.argv)